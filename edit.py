@@ -1,6 +1,9 @@
+import os
+import re
 import sys
 import shutil
 import subprocess
+import tempfile
 
 
 ErrType = tuple[int, str]
@@ -12,9 +15,8 @@ def linter(filename: str, linter: str = "mypy") -> list[ErrType]:
     except subprocess.CalledProcessError as err:
         out = err.output.decode("UTF-8")
     ret = []
-    for i in out.split("\n")[:-2]:
-        j = i.split(":")
-        ret.append((int(j[1]) - 1, j[3]))
+    for m in re.finditer(r"^[^:\n]*:(\d+):(?:\d+:)? \w+: (.*)$", out, re.MULTILINE):
+        ret.append((int(m[1]) - 1, m[2]))
     return ret
 
 
@@ -42,9 +44,6 @@ def setmode():
     termios.tcsetattr(sys.stdin, termios.TCSAFLUSH, mode)
 
 
-setmode()
-
-
 class TC:
     """Terminal colors"""
 
@@ -164,8 +163,20 @@ class Buffer:
             self.buf = fp.read().split("\n")
 
     def save(self):
-        with open(self.filename, "w") as fp:
-            fp.write("\n".join(self.buf))
+        # Write a temporary file and rename it over the original, so a crash
+        # never leaves a half-written file behind.
+        directory = os.path.dirname(os.path.abspath(self.filename))
+        fd, tmp = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as fp:
+                fp.write("\n".join(self.buf))
+                fp.flush()
+                os.fsync(fp.fileno())
+            shutil.copymode(self.filename, tmp)
+            os.replace(tmp, self.filename)
+        except BaseException:
+            os.unlink(tmp)
+            raise
         # self.relint()
 
     def relint(self):
@@ -345,5 +356,7 @@ class Buffer:
         self.scroll += 1
 
 
-BUF = Buffer(sys.argv[1])
-BUF.run()
+if __name__ == "__main__":
+    setmode()
+    BUF = Buffer(sys.argv[1])
+    BUF.run()
@@ -1,15 +1,62 @@
+import os
+import sys
+import time
+
+# Run as `python edit` or `python -m edit`.
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
 import terminal as term
-from buffer import Buffer
+import timing
+from backend import TTY
+from session import Session
 
-term.setmode()
+# At most this many frames are drawn per second, input that arrives in
+# between is applied to the buffer without drawing.
+FPS = float(os.environ.get("EDIT_FPS", 60))
 
-buffer = Buffer("test_file.py")
+# Time every frame and write the timings to this file, see timing.py.
+profile = os.environ.get("EDIT_PROFILE")
+args = []
+for arg in sys.argv[1:]:
+    if arg == "--profile" or arg.startswith("--profile="):
+        profile = arg.partition("=")[2] or "edit-profile.jsonl"
+    else:
+        args.append(arg)
+if profile:
+    timing.start(profile)
 
-while True:
-    buffer.render()
-    try:
-        buffer.editor()
-    except KeyboardInterrupt:
-        break
+if not os.isatty(sys.stdin.fileno()):
+    # Text is piped in, e.g. `command | python edit -`, read keys from the
+    # terminal instead.
+    term.use(TTY(infd=os.open("/dev/tty", os.O_RDONLY)))
 
-term.chf()
+session = Session(
+    args,
+    budget=int(os.environ.get("EDIT_MEMORY_BUDGET", 256 << 20)),
+    journal=os.environ.get("EDIT_JOURNAL", "1") != "0",
+    undo_budget=int(os.environ.get("EDIT_UNDO_BUDGET", 64 << 20)),
+)
+
+term.setmode()
+# Whatever ends the loop, the terminal is put back the way it was.
+try:
+    while True:
+        session.render()
+        drawn = time.monotonic()
+        try:
+            session.editor()
+            while True:
+                wait = drawn + 1 / FPS - time.monotonic()
+                if wait <= 0:
+                    session.editor(0)
+                    break
+                session.editor(wait)
+        except (KeyboardInterrupt, EOFError):
+            break
+finally:
+    timing.stop()
+    try:
+        session.close()
+    finally:
+        term.chf()
+        term.resetmode()
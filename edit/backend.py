@@ -0,0 +1,317 @@
+import codecs
+import os
+import re
+import select
+import signal
+import sys
+import termios
+from typing import Union
+from wrap import char_width
+
+
+class Backend:
+    """Where frames are written to and where input is read from."""
+
+    def size(self) -> tuple[int, int]:
+        """Return (width, height)."""
+        raise NotImplementedError
+
+    def write(self, data: bytes) -> int:
+        """Write a frame and return how many write calls it took."""
+        raise NotImplementedError
+
+    def read(self, timeout: float = None) -> Union[bytes, None]:
+        """Return the input available within `timeout` seconds.
+
+        Returns None if there was none, and b"" once the input has ended.
+        """
+        raise NotImplementedError
+
+    def resized(self) -> bool:
+        """Whether the size may have changed since the last call."""
+        return False
+
+    def setmode(self):
+        pass
+
+    def resetmode(self):
+        pass
+
+
+class TTY(Backend):
+    """A real terminal, stdin and stdout by default."""
+
+    def __init__(self, infd: int = None, outfd: int = None):
+        self.infd = sys.stdin.fileno() if infd is None else infd
+        self.outfd = sys.stdout.fileno() if outfd is None else outfd
+        self.saved = None
+        # Set by SIGWINCH, which also wakes read() up through the pipe.
+        self.resize = False
+        self.wakeup: Union[tuple[int, int], None] = None
+
+    def size(self) -> tuple[int, int]:
+        try:
+            return tuple(os.get_terminal_size(self.outfd))
+        except OSError:
+            # Not a terminal, shutil falls back to $COLUMNS and $LINES.
+            from shutil import get_terminal_size
+
+            return tuple(get_terminal_size())
+
+    def write(self, data: bytes) -> int:
+        data = memoryview(data)
+        calls = 0
+        while data:
+            data = data[os.write(self.outfd, data) :]
+            calls += 1
+        return calls
+
+    def read(self, timeout: float = None) -> Union[bytes, None]:
+        fds = [self.infd] if self.wakeup is None else [self.infd, self.wakeup[0]]
+        ready = select.select(fds, [], [], timeout)[0]
+        if self.wakeup and self.wakeup[0] in ready:
+            os.read(self.wakeup[0], 512)
+        if self.infd not in ready:
+            return None
+        return os.read(self.infd, 65536)
+
+    def resized(self) -> bool:
+        resize, self.resize = self.resize, False
+        return resize
+
+    def on_resize(self, signum, frame):
+        self.resize = True
+
+    def setmode(self):
+        """
+        I don't know what the fuck this does but it does something to the terminal
+        device as to not fuck me over.
+
+        References:
+          https://www.man7.org/linux/man-pages/man3/termios.3.html
+          https://man7.org/linux/man-pages/man1/stty.1.html
+          https://github.com/python/cpython/blob/3.10/Lib/tty.py
+        """
+        IFLAG = 0
+        LFLAG = 3
+        CC = 6
+        self.saved = termios.tcgetattr(self.infd)
+        mode = termios.tcgetattr(self.infd)
+        mode[LFLAG] = mode[LFLAG] & ~(termios.ECHO | termios.ICANON)
+        mode[IFLAG] = mode[IFLAG] & ~(termios.IXON | termios.IXOFF)
+        #                                     ^^^^ Allow Ctrl+S and Ctrl+Q to be read
+        mode[CC][termios.VMIN] = 1
+        mode[CC][termios.VTIME] = 0
+        # Disable the suspend character so Ctrl+Z can be read as undo.
+        mode[CC][termios.VSUSP] = bytes([os.fpathconf(self.infd, "PC_VDISABLE")])
+        termios.tcsetattr(self.infd, termios.TCSAFLUSH, mode)
+        # Signals write to the pipe, so a resize interrupts the wait for keys.
+        self.wakeup = os.pipe()
+        for fd in self.wakeup:
+            os.set_blocking(fd, False)
+        signal.set_wakeup_fd(self.wakeup[1])
+        signal.signal(signal.SIGWINCH, self.on_resize)
+
+    def resetmode(self):
+        if self.saved is not None:
+            termios.tcsetattr(self.infd, termios.TCSAFLUSH, self.saved)
+        if self.wakeup is not None:
+            signal.signal(signal.SIGWINCH, signal.SIG_DFL)
+            signal.set_wakeup_fd(-1)
+            for fd in self.wakeup:
+                os.close(fd)
+            self.wakeup = None
+
+
+TOKEN = re.compile(r"\x1b\[([0-?]*)[ -/]*([@-~])|\x1b.?|[\r\n\b]|[^\x1b\r\n\b]+")
+
+
+class VirtualScreen(Backend):
+    """An in-memory terminal that interprets the escape sequences we emit.
+
+    Frames are only parsed when the screen is looked at, so writing to it is
+    as cheap as appending to a list. Input is given with feed(), and reading
+    past the end of it ends the input. Characters take as many cells as they
+    take columns, the second cell of a wide character holds "".
+    """
+
+    def __init__(self, width: int = 80, height: int = 24):
+        self.width = width
+        self.height = height
+        self.input = bytearray()
+        self.pending: list[bytes] = []
+        self.utf8 = codecs.getincrementaldecoder("utf-8")("replace")
+        self.x = 0
+        self.y = 0
+        self.wrap = False
+        # (foreground, background) SGR codes, None for the default color.
+        self.attr: tuple = (None, None)
+        self.chars: list[list[str]] = []
+        self.attrs: list[list[tuple]] = []
+        self.erase(0, 0, width, height)
+        self.resize_pending = False
+
+    def size(self) -> tuple[int, int]:
+        return self.width, self.height
+
+    def resize(self, width: int, height: int):
+        """Change the size, like a terminal window being resized."""
+        self.parse()
+        for row in range(len(self.chars)):
+            self.chars[row] = (self.chars[row] + [" "] * width)[:width]
+            self.attrs[row] = (self.attrs[row] + [(None, None)] * width)[:width]
+        del self.chars[height:], self.attrs[height:]
+        while len(self.chars) < height:
+            self.chars.append([" "] * width)
+            self.attrs.append([(None, None)] * width)
+        self.width, self.height = width, height
+        self.x, self.y = min(self.x, width - 1), min(self.y, height - 1)
+        self.resize_pending = True
+
+    def resized(self) -> bool:
+        resize, self.resize_pending = self.resize_pending, False
+        return resize
+
+    def write(self, data: bytes) -> int:
+        self.pending.append(bytes(data))
+        return 1
+
+    def feed(self, data: Union[bytes, str]):
+        """Queue input for read()."""
+        self.input += data.encode() if isinstance(data, str) else data
+
+    def read(self, timeout: float = None) -> Union[bytes, None]:
+        if not self.input:
+            return b"" if timeout is None else None
+        data = bytes(self.input)
+        self.input.clear()
+        return data
+
+    def rows(self) -> list[str]:
+        """Return the text on every row of the screen."""
+        self.parse()
+        return ["".join(row) for row in self.chars]
+
+    def cursor(self) -> tuple[int, int]:
+        self.parse()
+        return self.x, self.y
+
+    def attr_at(self, x: int, y: int) -> tuple:
+        self.parse()
+        return self.attrs[y][x]
+
+    def erase(self, x: int, y: int, x2: int, y2: int):
+        """Blank rows y to y2 from column x on the first row to x2 on the last."""
+        while len(self.chars) < self.height:
+            self.chars.append([" "] * self.width)
+            self.attrs.append([(None, None)] * self.width)
+        blank = (None, self.attr[1])
+        for row in range(y, y2):
+            start = x if row == y else 0
+            stop = x2 if row == y2 - 1 else self.width
+            chars = self.chars[row]
+            # A wide character cut in half is blanked whole.
+            if 0 < start < self.width and not chars[start]:
+                chars[start - 1] = " "
+            if stop < self.width and not chars[stop]:
+                chars[stop] = " "
+            chars[start:stop] = [" "] * (stop - start)
+            self.attrs[row][start:stop] = [blank] * (stop - start)
+
+    def newline(self):
+        self.y += 1
+        if self.y == self.height:
+            del self.chars[0], self.attrs[0]
+            self.y -= 1
+            self.erase(0, self.y, self.width, self.height)
+
+    def parse(self):
+        text = self.utf8.decode(b"".join(self.pending))
+        self.pending.clear()
+        for m in TOKEN.finditer(text):
+            token = m[0]
+            if m[2]:
+                self.csi(m[1], m[2])
+            elif token[0] == "\x1b":
+                pass
+            elif token == "\r":
+                self.x = 0
+                self.wrap = False
+            elif token == "\n":
+                self.newline()
+            elif token == "\b":
+                self.x = max(0, self.x - 1)
+            else:
+                for c in token:
+                    self.put(c)
+
+    def put(self, c: str):
+        """Write a character at the cursor and move past it."""
+        w = char_width(c)
+        if not w:
+            # Combining characters join the character before them.
+            x = self.x if self.wrap else self.x - 1
+            while x > 0 and not self.chars[self.y][x]:
+                x -= 1
+            if x >= 0:
+                self.chars[self.y][x] += c
+            return
+        if self.wrap or self.x + w > self.width:
+            self.x = 0
+            self.wrap = False
+            self.newline()
+        row = self.chars[self.y]
+        # Overwriting half of a wide character blanks the other half.
+        if not row[self.x]:
+            row[self.x - 1] = " "
+        end = self.x + w
+        if end < self.width and not row[end]:
+            row[end] = " "
+        row[self.x] = c
+        self.attrs[self.y][self.x] = self.attr
+        if w == 2:
+            row[self.x + 1] = ""
+            self.attrs[self.y][self.x + 1] = self.attr
+        if end == self.width:
+            self.x = self.width - 1
+            self.wrap = True
+        else:
+            self.x = end
+
+    def csi(self, params: str, final: str):
+        args = [int(p) if p.isdigit() else 0 for p in params.split(";")]
+        n = args[0] or 1
+        self.wrap = False
+        if final in "Hf":
+            row, col = (args + [0, 0])[:2]
+            self.y = min(max(row, 1), self.height) - 1
+            self.x = min(max(col, 1), self.width) - 1
+        elif final == "J" and args[0] in (0, 2):
+            if args[0] == 2:
+                self.erase(0, 0, self.width, self.height)
+            else:
+                self.erase(self.x, self.y, self.width, self.height)
+        elif final == "K":
+            self.erase(self.x, self.y, self.width, self.y + 1)
+        elif final == "A":
+            self.y = max(0, self.y - n)
+        elif final == "B":
+            self.y = min(self.height - 1, self.y + n)
+        elif final == "C":
+            self.x = min(self.width - 1, self.x + n)
+        elif final == "D":
+            self.x = max(0, self.x - n)
+        elif final == "m" and not params.startswith("?"):
+            fg, bg = self.attr
+            for code in args:
+                if code == 0:
+                    fg, bg = None, None
+                elif 30 <= code <= 37 or 90 <= code <= 97:
+                    fg = code
+                elif code == 39:
+                    fg = None
+                elif 40 <= code <= 47 or 100 <= code <= 107:
+                    bg = code
+                elif code == 49:
+                    bg = None
+            self.attr = (fg, bg)
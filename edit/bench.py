@@ -0,0 +1,457 @@
+"""
+Keystroke-replay benchmarks.
+
+Runs scripted key traces through Buffer.handle() and Buffer.render() against
+generated files, writing frames to a VirtualScreen (or a pseudo-terminal with
+--pty). Every (size, trace) case runs in its own process so that peak memory is
+measured per case. The startup case instead times the editor itself from
+launch to its first frame. Results are printed as one JSON object per line, a
+summary goes to stderr. With --fuzz, the rope, the match index, file diffs and
+journal records are checked against plain lists, sets and difflib instead.
+
+Usage:
+  python edit/bench.py [--sizes 1K,1M,64M] [--traces type,scroll] [--pty]
+                       [--output FILE]
+  python edit/bench.py --fuzz ROUNDS [--seed SEED]
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import select
+import subprocess
+import sys
+import tempfile
+import termios
+import threading
+import time
+
+import terminal as term
+from backend import TTY, VirtualScreen
+from timing import percentiles
+
+WIDTH, HEIGHT = 120, 40
+# Milliseconds from launching the editor to its first frame, at any size.
+STARTUP_TARGET_MS = 150
+UNITS = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+
+SAMPLE = """\
+def handle_{n}(self, key: str) -> None:
+    # Dispatch a single key to the matching command.
+    if key in self.functions:
+        self.functions[key]()
+    elif len(key) == 1:
+        self.insert(key)  # "plain" text
+    message = f'handled {{key!r}} at {n}'
+    return None
+
+"""
+
+TYPED = 'def f(x):\n    return "x" + x  # comment\n' * 10
+
+# name: (where the cursor starts, keys)
+TRACES = {
+    "type": ("middle", lambda: list(TYPED)),
+    "scroll": ("top", lambda: ["DOWN_ARROW"] * 300 + ["UP_ARROW"] * 300),
+    "pages": ("middle", lambda: ["PG_DOWN"] * 200 + ["PG_UP"] * 200),
+    "lines": ("middle", lambda: ["\n", "BACKSPACE"] * 200),
+    "words": ("top", lambda: ["CTRL_RIGHT_ARROW"] * 200 + ["CTRL_LEFT_ARROW"] * 200),
+    "paste": ("middle", lambda: [term.Paste("x = 'pasted'  # line\n" * 5000)]),
+    # Edits that remove the lines at the top of the screen.
+    "undo": ("middle", lambda: [term.Paste("x = 'pasted'  # line\n" * 5000), "CTRL_Z"]),
+    "clear": (
+        "middle",
+        lambda: ["CTRL_A", "BACKSPACE", "CTRL_Z", "CTRL_A", "CTRL_X", "CTRL_Z"]
+        + ["CTRL_A", *TYPED],
+    ),
+    # Motions that drop the selection, then ones that extend it.
+    "select": (
+        "middle",
+        lambda: ["SHIFT_DOWN_ARROW"] * 3
+        + ["ALT_RIGHT_ARROW", "ALT_DOWN_ARROW", "PG_DOWN", "x", "CTRL_Z"]
+        + ["ALT_SHIFT_RIGHT_ARROW"] * 20
+        + ["ALT_SHIFT_DOWN_ARROW"] * 20
+        + ["BACKSPACE", "CTRL_Z"],
+    ),
+}
+
+
+def parse_size(size: str) -> int:
+    size = size.strip().upper()
+    if size[-1] in UNITS:
+        return int(float(size[:-1]) * UNITS[size[-1]])
+    return int(size)
+
+
+def generate(size: int, directory: str) -> str:
+    """Write a Python-like file of `size` bytes and return its path."""
+    path = os.path.join(directory, f"bench_{size}.py")
+    if os.path.exists(path) and os.path.getsize(path) == size:
+        return path
+    block = "".join(SAMPLE.format(n=n) for n in range(2000)).encode()
+    with open(path, "wb") as fp:
+        left = size
+        while left > 0:
+            fp.write(block[:left])
+            left -= len(block)
+    return path
+
+
+def drain(fd: int):
+    try:
+        while os.read(fd, 1 << 16):
+            pass
+    except OSError:
+        pass
+
+
+def check(screen: VirtualScreen, buffer) -> bool:
+    """Whether the screen shows the lines the buffer should be showing."""
+    rows = screen.rows()[:-1]
+    gutter = buffer.gutter()
+    wrap = buffer.wrap.width
+    expected = []
+    lines = buffer.buf.lines(buffer.scroll, buffer.scroll + len(rows))
+    for y, line in enumerate(lines, buffer.scroll):
+        for a in range(0, len(line) + 1, wrap) if wrap else (0,):
+            number = str(1 + y) if a == 0 else ""
+            expected.append(number.rjust(gutter - 1) + " " + line[a:][: WIDTH - gutter])
+    expected = expected[buffer.sub :]
+    return all(a.rstrip() == b.rstrip() for a, b in zip(rows, expected))
+
+
+def run_case(path: str, trace: str, pty: bool) -> dict:
+    """Load `path`, replay `trace` and return the measurements."""
+    from buffer import Buffer
+
+    if pty:
+        master, slave = os.openpty()
+        threading.Thread(target=drain, args=(master,), daemon=True).start()
+        termios.tcsetwinsize(slave, (HEIGHT, WIDTH))
+        screen = TTY(outfd=slave)
+    else:
+        screen = VirtualScreen(WIDTH, HEIGHT)
+    term.use(screen)
+
+    start = time.perf_counter()
+    buffer = Buffer(path)
+    buffer.render()
+    first_paint = time.perf_counter() - start
+    buffer.finish_load(wait=True)
+    load = time.perf_counter() - start
+
+    where, keys = TRACES[trace]
+    if where == "middle":
+        buffer.cy = len(buffer.buf) // 2
+        buffer.scroll = max(0, buffer.cy - HEIGHT // 2)
+    buffer.render()
+
+    latency = []
+    sizes = []
+    writes = []
+    for key in keys():
+        written, calls = term.written, term.writes
+        start = time.perf_counter()
+        buffer.handle(key)
+        buffer.render()
+        latency.append((time.perf_counter() - start) * 1000)
+        sizes.append(term.written - written)
+        writes.append(term.writes - calls)
+        if not pty:
+            screen.parse()
+
+    return {
+        "trace": trace,
+        "bytes": os.path.getsize(path),
+        "lines": len(buffer.buf),
+        "keys": len(latency),
+        "first_paint_s": first_paint,
+        "load_s": load,
+        "latency_ms": percentiles(latency),
+        "bytes_per_frame": percentiles(sizes),
+        "writes_per_frame": sum(writes) / max(1, len(writes)),
+        "screen_ok": None if pty else check(screen, buffer),
+        # ru_maxrss is in KiB on Linux and bytes on macOS.
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        // (1024 if sys.platform == "darwin" else 1),
+    }
+
+
+def startup(path: str) -> dict:
+    """Time `python edit PATH` from launch to its first frame on a pty."""
+    master, slave = os.openpty()
+    termios.tcsetwinsize(slave, (HEIGHT, WIDTH))
+    env = dict(os.environ, EDIT_LINT="", EDIT_JOURNAL="0")
+    editor = os.path.dirname(os.path.abspath(__file__))
+    start = time.perf_counter()
+    proc = subprocess.Popen(
+        [sys.executable, editor, path],
+        stdin=slave,
+        stdout=slave,
+        stderr=subprocess.DEVNULL,
+        env=env,
+        start_new_session=True,
+    )
+    os.close(slave)
+    out = b""
+    # The status line is the last thing drawn.
+    while b"-- INSERT --" not in out and select.select([master], [], [], 10)[0]:
+        out += os.read(master, 1 << 16)
+    elapsed = (time.perf_counter() - start) * 1000
+    proc.kill()
+    proc.wait()
+    os.close(master)
+    return {
+        "trace": "startup",
+        "bytes": os.path.getsize(path),
+        "startup_ms": elapsed,
+        "target_ms": STARTUP_TARGET_MS,
+        "ok": elapsed <= STARTUP_TARGET_MS,
+    }
+
+
+def fuzz_rope(rng: random.Random):
+    from storage import LEAF_MAX, MappedLines, Rope, index_lines
+
+    lines = [f"{n}" * rng.randrange(3) for n in range(rng.randrange(4 * LEAF_MAX))]
+    data = "\n".join(lines).encode()
+    rope = Rope(MappedLines(data, index_lines(data)))
+    snapshots = []
+
+    def pick(lo: int = 0) -> int:
+        """A line from `lo` on, half the time next to where a leaf ends."""
+        if rng.randrange(2):
+            ends = [0]
+            for leaf in rope._leaves(rope.root):
+                ends.append(ends[-1] + leaf.size)
+            y = rng.choice(ends) + rng.randint(-1, 1)
+        else:
+            y = lo + rng.choice((0, 1, 100, 3 * LEAF_MAX))
+        return min(max(y, lo), len(lines))
+
+    for step in range(40):
+        a = pick()
+        b = pick(a)
+        op = rng.randrange(4)
+        if op == 0:
+            new = [f"{step}.{k}" for k in range(rng.choice((0, 1, 50, 2 * LEAF_MAX)))]
+            rope.splice(a, b, new)
+            lines[a:b] = new
+        elif op == 1:
+            # Large slices are ropes sharing leaves, spliced back in whole.
+            piece = rope.slice(a, b)
+            c = pick()
+            d = pick(c)
+            rope.splice(c, d, piece)
+            lines[c:d] = lines[a:b]
+        elif op == 2 and lines:
+            y = rng.randrange(len(lines))
+            rope[y] = f"set {step}"
+            lines[y] = f"set {step}"
+        else:
+            snapshots.append((rope.snapshot(), list(lines)))
+        assert len(rope) == len(lines) and list(rope) == lines, step
+    for snapshot, copy in snapshots:
+        assert list(snapshot) == copy
+    assert b"".join(rope.encode()) == "\n".join(lines).encode()
+
+
+def fuzz_index(rng: random.Random):
+    from search import MatchIndex
+
+    index = MatchIndex()
+    # Small blocks, so they are split and emptied often.
+    index.BLOCK = rng.choice((1, 2, 8))
+    found: set[int] = set()
+    for step in range(200):
+        op = rng.randrange(4)
+        if op == 0:
+            y = rng.randrange(300)
+            index.add(y)
+            found.add(y)
+        elif op == 1:
+            ys = sorted(rng.sample(range(300), rng.randrange(20)))
+            index.update(ys)
+            found.update(ys)
+        elif op == 2:
+            start = rng.randrange(300)
+            stop = rng.randint(start, start + rng.randrange(30))
+            n = rng.randrange(30)
+            index.splice(start, stop, n)
+            delta = n - (stop - start)
+            found = {y + delta * (y >= stop) for y in found if not start <= y < stop}
+        y = rng.randrange(-1, 320)
+        after = [z for z in found if z > y]
+        before = [z for z in found if z < y]
+        assert len(index) == len(found), step
+        assert index.next(y) == (min(after) if after else None), step
+        assert index.prev(y) == (max(before) if before else None), step
+
+
+def fuzz_diff(rng: random.Random):
+    import difflib
+    from storage import BLOCK, Blocks, Rope, split_lines
+    from watch import diff
+
+    words = ["alpha", "beta", "", "    gamma", "delta = 1"]
+    eol = rng.choice(("\n", "\r\n"))
+    n = rng.choice((0, 3, 1000, 20000, 100000))
+    varied = rng.randrange(4)
+    if varied:
+        old = [rng.choice(words) + str(rng.randrange(50)) for _ in range(n)]
+    else:
+        # Repeated lines, whose blocks match in many places.
+        old = (words * n)[:n]
+    old_data = eol.join(old).encode()
+    new = list(old)
+    # Edits close together, often around where a block starts.
+    around = rng.randint(0, len(old))
+    if rng.randrange(2):
+        block = rng.randint(0, len(old_data) // BLOCK)
+        around = old_data.count(b"\n", 0, block * BLOCK)
+    for _ in range(rng.randrange(1, 4)):
+        a = min(len(new), max(0, around + rng.randint(-20, 20)))
+        if varied:
+            b = rng.randint(a, min(len(new), a + 20))
+            new[a:b] = [rng.choice(words) for _ in range(rng.randrange(20))]
+        else:
+            # Whole repeats, up to many blocks of them, so the blocks after
+            # them match where others were.
+            a -= a % len(words)
+            b = rng.randint(a, min(len(new), a + rng.choice((20, 50000))))
+            b -= (b - a) % len(words)
+            new[a:b] = words * rng.randrange(3)
+    new_data = eol.join(new).encode()
+    buf = Rope(split_lines(old_data))
+    splices = diff(Blocks(old_data), buf, new_data)
+    for start, stop, lines in reversed(splices):
+        buf.splice(start, stop, lines)
+    assert list(buf) == split_lines(new_data)
+    if not varied:
+        # Many lines are compared and replaced in chunks, see watch.DIFF_LIMIT.
+        return
+    # No more lines change than difflib changes, in the lines between the
+    # ones both start and end with.
+    head = 0
+    while head < min(len(old), len(new)) and old[head] == new[head]:
+        head += 1
+    tail = 0
+    while tail < min(len(old), len(new)) - head and old[-1 - tail] == new[-1 - tail]:
+        tail += 1
+    a, b = old[head : len(old) - tail], new[head : len(new) - tail]
+    opcodes = difflib.SequenceMatcher(None, a, b, autojunk=False).get_opcodes()
+    changed = sum(i2 - i1 for tag, i1, i2, _, _ in opcodes if tag != "equal")
+    assert sum(stop - start for start, stop, _ in splices) <= changed + 1
+
+
+def fuzz_journal(rng: random.Random, directory: str):
+    import journal
+
+    path = os.path.join(directory, "fuzz.txt")
+    with open(path, "wb") as fp:
+        fp.write(b"text\n")
+    log = journal.Journal(path)
+    log.clear()
+    records = []
+    for _ in range(rng.randrange(1, 20)):
+        start = rng.randrange(100)
+        lines = ["".join(rng.choice("ab\t\u00e9\u6f22\udc80") for _ in range(5))]
+        record = (start, start + rng.randrange(3), lines * rng.randrange(3))
+        encoded = journal.encode(*record)
+        assert journal.decode(encoded[journal.RECORD.size :]) == record
+        log.record(*record)
+        records.append(record)
+    log.close()
+    # A crash during a write leaves a torn record at the end.
+    size = os.path.getsize(log.path)
+    with open(log.path, "r+b") as fp:
+        fp.truncate(rng.randint(journal.HEADER.size, size))
+    replayed = list(journal.Journal(path).replay())
+    assert replayed == records[: len(replayed)]
+    log.clear()
+
+
+def fuzz(rounds: int, seed: int, directory: str) -> dict:
+    """Check the rope, the match index, file diffs and journal records
+    against plain lists, sets and difflib on `rounds` random cases each."""
+    os.makedirs(directory, exist_ok=True)
+    for name, check in (
+        ("rope", fuzz_rope),
+        ("index", fuzz_index),
+        ("diff", fuzz_diff),
+        ("journal", lambda rng: fuzz_journal(rng, directory)),
+    ):
+        for n in range(rounds):
+            try:
+                check(random.Random(f"{seed}.{n}"))
+            except AssertionError as e:
+                raise AssertionError(f"fuzz {name} round {n} seed {seed}: {e}") from e
+    return {"trace": "fuzz", "rounds": rounds, "seed": seed, "ok": True}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--sizes", default="1K,1M,64M")
+    parser.add_argument("--traces", default=",".join([*TRACES, "startup"]))
+    parser.add_argument("--dir", default=os.path.join(tempfile.gettempdir(), "edit"))
+    parser.add_argument("--output", help="append results to this file")
+    parser.add_argument("--pty", action="store_true", help="write to a pty")
+    parser.add_argument("--case", nargs=2, metavar=("PATH", "TRACE"))
+    parser.add_argument("--fuzz", type=int, metavar="ROUNDS")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.fuzz:
+        print(json.dumps(fuzz(args.fuzz, args.seed, args.dir)))
+        return
+
+    if args.case:
+        path, trace = args.case
+        if trace == "startup":
+            print(json.dumps(startup(path)))
+        else:
+            print(json.dumps(run_case(path, trace, args.pty)))
+        return
+
+    os.makedirs(args.dir, exist_ok=True)
+    meta = {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+    }
+    out = open(args.output, "a") if args.output else sys.stdout
+    for size in args.sizes.split(","):
+        path = generate(parse_size(size), args.dir)
+        for trace in args.traces.split(","):
+            proc = subprocess.run(
+                [sys.executable, __file__, "--case", path, trace]
+                + ["--pty"] * args.pty,
+                stdout=subprocess.PIPE,
+                check=True,
+            )
+            result = {**meta, "size": size, **json.loads(proc.stdout)}
+            print(json.dumps(result), file=out, flush=True)
+            if trace == "startup":
+                print(
+                    f"{size:>6} {trace:<8} first frame {result['startup_ms']:7.1f} ms"
+                    f"  target {STARTUP_TARGET_MS} ms"
+                    f"  {'ok' if result['ok'] else 'MISSED'}",
+                    file=sys.stderr,
+                )
+                continue
+            print(
+                f"{size:>6} {trace:<8} paint {result['first_paint_s'] * 1000:7.1f} ms"
+                f"  load {result['load_s'] * 1000:8.1f} ms"
+                f"  p50 {result['latency_ms']['p50']:7.3f} ms"
+                f"  p99 {result['latency_ms']['p99']:7.3f} ms"
+                f"  {result['bytes_per_frame']['mean']:8.0f} B/frame"
+                f"  {result['peak_rss_kb'] // 1024:6} MiB",
+                file=sys.stderr,
+            )
+
+
+if __name__ == "__main__":
+    main()
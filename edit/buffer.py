@@ -1,13 +1,124 @@
-from typing import Union
+import mmap
+import os
+import queue
+import threading
+import zlib
+from typing import TYPE_CHECKING, Union
 import terminal as term
+import timing
+from highlight import Highlighter, lex
+from journal import Journal, base
+import motion
+from storage import BLOCK, Blocks, MappedLines, Rope, map_file, save, stream_lines
+from undo import Undo
+from wrap import TABSTOP, Wrap, fit, layout
+
+if TYPE_CHECKING:
+    from lint import Linter
+    from search import Search
+
+# Bytes of a file indexed before it is first drawn, the rest is indexed in
+# the background.
+HEAD = 1 << 16
 
 
 def isid(c: str) -> bool:
     return c.isalnum() or c in "_"
 
 
+SELECTED = term.bgwhite + term.black
+MATCH = term.bgyellow + term.black
+# Colors that set a background, which has to be reset after them.
+OVERLAYS = (SELECTED, MATCH)
+INDENT = " " * TABSTOP
+# Keys that only move the cursor or the screen, which select text when SHIFT
+# is held too.
+MOTIONS = {
+    "RIGHT_ARROW",
+    "LEFT_ARROW",
+    "UP_ARROW",
+    "DOWN_ARROW",
+    "HOME",
+    "END",
+    "PG_UP",
+    "PG_DOWN",
+    "CTRL_RIGHT_ARROW",
+    "CTRL_LEFT_ARROW",
+    "CTRL_UP_ARROW",
+    "CTRL_DOWN_ARROW",
+    "ALT_RIGHT_ARROW",
+    "ALT_LEFT_ARROW",
+    "ALT_UP_ARROW",
+    "ALT_DOWN_ARROW",
+}
+
+
+def overlay(runs: list, a: int, b: int, color: str) -> list:
+    """Recolor columns a to b of (start, end, color) runs."""
+    split = []
+    for s, e, c in runs:
+        for lo, hi, col in (
+            (s, min(e, a), c),
+            (max(s, a), min(e, b), color),
+            (max(s, b), e, c),
+        ):
+            if lo < hi:
+                split.append((lo, hi, col))
+    return split
+
+
+def render_line(
+    line: str, y: int, cy, selected, errs, spans, found=(), gutter=4, wrap=0
+) -> list[str]:
+    """Return the screen rows for one line, colored by its highlight spans,
+    search matches and the selected characters, as a range or None. Lines are
+    wrapped every `wrap` columns, or cut off at the edge of the screen if it
+    is 0. Spans are in characters, not columns."""
+    bg = term.bgblack if cy == y else term.bgred if y in errs else ""
+    runs = []
+    x = 0
+    for start, end, color in spans:
+        if x < start:
+            runs.append((x, start, term.white))
+        if start < end:
+            runs.append((start, end, color))
+        x = end
+    if x < len(line):
+        runs.append((x, len(line), term.white))
+    for a, b in found:
+        runs = overlay(runs, a, b, MATCH)
+    if selected:
+        runs = overlay(runs, *selected, SELECTED)
+    width = term.width - gutter
+    lay = layout(line, wrap)
+    rows = []
+    for row in range(lay.rows()):
+        a, b = lay.span(row)
+        if not wrap:
+            b = lay.cut(width)
+        number = str(1 + y) if row == 0 else ""
+        out = [bg, number.rjust(gutter - 1), " "]
+        w = out.append
+        # Characters are written in runs between escapes, and an escape is
+        # only written when the color changes.
+        last = None
+        for start, end, color in runs:
+            start, end = max(start, a), min(end, b)
+            if start >= end:
+                continue
+            if color != last:
+                w(term.reset + bg + color if last in OVERLAYS else color)
+                last = color
+            w(lay.text(line, start, end))
+        if last in OVERLAYS:
+            w(term.reset + bg)
+        w(" " * (width - (lay.width(row) if wrap else lay.x(b))) + term.reset)
+        rows.append("".join(out))
+    return rows
+
+
 def render_buffer(
-    buf: list[str],
+    buf: Rope,
     cx,
     cy,
     sx1,
@@ -18,79 +129,554 @@ def render_buffer(
     errs: dict[int, str],
     self,
 ):
-    term.chf()
-    color = term.white
-    quoted = False
-    y = scroll
-    while y < min(term.height - 1 + scroll, len(buf)):
-        if cy == y:
-            term.w(term.bgblack)
-        elif y in errs:
-            term.w(term.bgred)
-        term.w(str(1 + y).rjust(3) + " " + color)
-        x = 0
-        while x < len(buf[y]):
-            if sx1 + sy1 + sx2 + sy2 != 0:
-                if x == sx1 and y == sy1:
-                    color = term.bgwhite + term.black
-                    term.w(color)
-                elif x == sx2 and y == sy2:
-                    color = term.white + term.bgblack
-                    term.w(color)
-            if quoted:
-                term.w(buf[y][x])
-                if buf[y][x] == '"':
-                    quoted = False
-                    color = term.white
-                    term.w(color)
-            else:
-                if buf[y][x] == '"':
-                    quoted = True
-                    color = term.brgreen
-                    term.w(color)
-                elif buf[y][x] == "#":
-                    term.w(term.brblack)
-                term.w(buf[y][x])
-            x += 1
-        term.w(" " * (term.width - len(buf[y]) - 4) + "\n" + term.reset)
+    # self.screen remembers, for every row drawn last frame, the inputs that
+    # produced it and its text. Rows whose inputs are unchanged are skipped,
+    # and only rows whose text changed are written, so an edit or cursor move
+    # only redraws the rows it touched.
+    rows = term.height - 1
+    if len(self.screen) != rows:
+        term.c()
+        self.screen = [None] * rows
+    gutter = self.gutter()
+    wrap = self.wrap.width
+    selecting = (sx1, sy1) != (sx2, sy2)
+    search = self.search
+    lines = buf.lines(scroll, scroll + rows)
+    y, sub = scroll, self.sub
+    cursor = None
+    row = 0
+    while row < rows:
+        line = next(lines, None)
+        state = None if line is None else self.hl.state(y)
+        found = search.spans(line) if search and line is not None else ()
+        # Only the part of the selection on this line is part of its key, so
+        # changing the selection redraws the lines it changed on.
+        selected = None
+        if selecting and sy1 <= y <= sy2 and line is not None:
+            selected = (sx1 if y == sy1 else 0, sx2 if y == sy2 else len(line))
+        key = (y, line, state, y == cy, errs.get(y), selected, found, gutter, wrap)
+        if y == cy:
+            cursor = row + self.wrap.row(cy, cx) - sub
+        texts = None
+        for r in range(sub, 1 if line is None else self.wrap.rows(y)):
+            if row == rows:
+                break
+            drawn = self.screen[row]
+            if drawn is None or drawn[0] != (key, r):
+                if line is None:
+                    text = "\u001b[K"
+                else:
+                    if texts is None:
+                        spans = lex(line, state)[0]
+                        texts = render_line(
+                            line, y, cy, selected, errs, spans, found, gutter, wrap
+                        )
+                    text = texts[r]
+                self.screen[row] = ((key, r), text)
+                if drawn is None or drawn[1] != text:
+                    term.m(0, row)
+                    term.w(text)
+            row += 1
         y += 1
+        sub = 0
+    term.m(0, rows)
     term.w(term.bgwhite + term.black)
-    term.w(f" -- INSERT --  {self.filename}  {1+self.cx}:{1+self.cy}".ljust(term.width))
+    err = f"  err: {errs[cy]}" if cy in errs else ""
+    modified = "*" if self.version != self.saved else ""
+    msg = f"  {self.msg}" if self.msg else ""
+    if self.loader:
+        done, size = self.progress
+        progress = f"{100 * done // size}%" if size else f"{done >> 20} MiB"
+        msg += f"  loading {progress}"
+    name = self.filename or "untitled"
+    status = f" -- INSERT --  {name}{modified}  {1+self.cx}:{1+self.cy}{msg}{err}"
+    if self.searching:
+        prompt = f" {'REGEX' if search.regex else 'SEARCH'}: {search.query}"
+        info = f"  {len(search.index)} matches{'...' if search.scanning else ''}"
+        status = prompt + (f"  error: {search.error}" if search.error else info)
+    if timing.profiler:
+        shown = timing.profiler.status()[: term.width]
+        rest = term.width - len(shown)
+        status = fit(status, rest) + shown
+    term.w(fit(status, term.width))
     term.w(term.reset)
-    term.m(4 + cx, cy - scroll)
+    if self.searching:
+        x = layout(prompt).x(len(prompt))
+        term.m(min(x, term.width - 1), rows)
+    else:
+        x = self.wrap.layout(cy).x(cx)
+        term.m(min(gutter + x, term.width - 1), cursor or 0)
     term.f()
 
 
 class Buffer:
-    def __init__(self, filename: str = None):
+    # Text copied or cut from any buffer.
+    clipboard = ""
+
+    def __init__(self, filename: str = None, storage=Rope, lazy: bool = False):
         self.filename: Union[str, None] = filename
-        self.buf: list[str] = [""]
+        # Any class taking an iterable of lines and implementing the Rope
+        # interface: len(), [y], [y] = line, insert, pop, splice and lines.
+        self.storage = storage
+        self.buf: Rope = storage([""])
+        self.hl = Highlighter(self.buf)
+        self.wrapping = True
+        self.wrap = Wrap(self.buf)
         self.errs: dict[int, str] = {}
+        self.screen: list = []
+        # The size of the terminal when last rendered.
+        self.size = (term.width, term.height)
+        # Bumped by every edit, so snapshots of the text can be told apart.
+        self.version: int = 0
+        self.linter: Union["Linter", None] = None
+        self.history = Undo()
+        # The version last written to or read from the file.
+        self.saved: int = 0
+        # (size, mtime_ns) of the file when it was last read or written.
+        self.stat = (-1, 0)
+        # (st_dev, st_ino, size, mtime_ns) of the file the lines are mapped
+        # from while it is still the file, see check_mapped().
+        self.mapped: Union[tuple[int, int, int, int], None] = None
+        # Hashes of the file as it was read or written, see check_file().
+        self.blocks: Union[Blocks, None] = None
+        self.saver: Union[threading.Thread, None] = None
+        self.saving: int = 0
+        self.journal: Union[Journal, None] = None
+        self.search: Union["Search", None] = None
+        # Whether keys edit the search query, and where the search started.
+        self.searching = False
+        self.origin = (0, 0, 0, 0)
+        self.seek = False
+        self.msg = ""
+        # ((version, lines), bytes) of the last memory() estimate.
+        self.measured = ((-1, 0), 0)
+        # Reads the rest of the file in the background and queues its lines
+        # for finish_load(), see load().
+        self.loader: Union[threading.Thread, None] = None
+        self.pieces: queue.SimpleQueue = queue.SimpleQueue()
+        # Bytes read so far, and in total if that is known.
+        self.progress = (0, 0)
         if self.filename:
-            self.reload()
+            if lazy:
+                self.buf = self.hl = self.wrap = None
+            else:
+                self.reload()
         self.cx: int = 0
         self.cy: int = 0
+        # The top of the screen is row `sub` of line `scroll`.
         self.scroll: int = 0
+        self.sub: int = 0
+        # The selection runs from (sx1, sy1) to (sx2, sy2), from wherever the
+        # cursor was when it started, the anchor, to the cursor.
+        self.anchor: Union[tuple[int, int], None] = None
         self.sx1: int = 0
         self.sy1: int = 0
         self.sx2: int = 0
         self.sy2: int = 0
 
     def reload(self):
-        with open(self.filename, "r") as fp:
-            self.buf = fp.read().split("\n")
+        self.stat = base(self.filename)
+        self.mapped = None
+        self.blocks = None
+        if os.path.exists(self.filename):
+            lines = MappedLines.open(self.filename, HEAD)
+            if isinstance(lines.data, mmap.mmap):
+                st = os.stat(self.filename)
+                self.mapped = (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+            self.buf = self.storage(lines)
+            if lines.complete():
+                self.blocks = Blocks(lines.data)
+            else:
+                pieces = ((piece, piece.offsets[-1]) for piece in lines.rest())
+                self.load(pieces, len(lines.data), lines.data)
+        else:
+            self.buf = self.storage([""])
+            self.blocks = Blocks(b"")
+        self.hl = Highlighter(self.buf)
+        self.wrap = Wrap(self.buf)
+        self.layout()
+        self.saved = self.version
+
+    def check_mapped(self):
+        """Read the file again if it was changed in place, not replaced, where
+        lines are still read from it.
+
+        Those mapped lines would show the new bytes at the old offsets, and
+        past its end if it shrank, where reading them kills the process. The
+        check is a stat() per frame, until the file is replaced, e.g. by a
+        save, after which the lines map a file nothing else can change. If
+        they are read again, unsaved edits are lost, their journal is kept as
+        "<journal>.stale".
+        """
+        if self.mapped is None or self.buf is None:
+            return
+        try:
+            st = os.stat(self.filename)
+        except OSError:
+            self.mapped = None
+            return
+        if (st.st_dev, st.st_ino) != self.mapped[:2]:
+            self.mapped = None
+        elif (st.st_size, st.st_mtime_ns) != self.mapped[2:]:
+            if self.intact():
+                # Touched, or changed where no lines are read from.
+                self.mapped = (*self.mapped[:2], st.st_size, st.st_mtime_ns)
+                return
+            edited = self.version != self.saved
+            kept = edited and self.journal and self.journal.set_aside()
+            self.reread()
+            self.msg = "file overwritten on disk, reloaded"
+            if kept:
+                self.msg += f", unsaved edits in {self.journal.path}.stale"
+            elif edited:
+                self.msg += ", unsaved edits lost"
+
+    def intact(self) -> bool:
+        """Whether the blocks of the file the mapped lines are read from are
+        as they were read or written, and still in the file."""
+        blocks = self.blocks
+        if blocks is None:
+            # Still loading, the blocks are hashed at the end.
+            return False
+        try:
+            data = map_file(self.filename)
+        except OSError:
+            return False
+        checked = set()
+        for lines in self.buf.mapped():
+            a, b = lines.offsets[lines.start], lines.offsets[lines.stop] - 1
+            for i in range(a // BLOCK, -(-b // BLOCK)):
+                if i in checked:
+                    continue
+                end = min((i + 1) * BLOCK, blocks.size)
+                if i >= len(blocks.crcs) or end > len(data):
+                    return False
+                if zlib.crc32(data[i * BLOCK : end]) != blocks.crcs[i]:
+                    return False
+                checked.add(i)
+        return True
+
+    def reread(self):
+        """Replace the lines with those of the file, from scratch, keeping
+        the cursor where it was as far as the file still reaches."""
+        # The loader reads the old lines, its pieces are dropped.
+        self.loader = None
+        self.pieces = queue.SimpleQueue()
+        if self.journal:
+            self.journal.clear()
+        self.version += 1
+        self.reload()
+        self.forget()
+        self.redraw()
+
+    def forget(self):
+        """Forget the undo history, selection, errors and matches of lines
+        that were replaced wholesale, and keep the cursor within the lines."""
+        self.history = Undo(self.history.budget)
+        self.deselect()
+        self.errs = {}
+        self.cy = min(self.cy, len(self.buf) - 1)
+        self.cx = min(self.cx, len(self.buf[self.cy]))
+        self.scroll, self.sub = min(self.scroll, self.cy), 0
+        if self.search:
+            self.search.start(self.buf, self.cy)
+        self.follow_cursor()
+
+    def unload(self) -> bool:
+        """Drop the lines, reload() and the journal bring them back.
+
+        Returns False, keeping them, if there are edits the journal lacks or
+        they were not read from a file.
+        """
+        if not self.filename:
+            return False
+        self.finish_save(wait=True)
+        if self.version != self.saved and not self.journal:
+            return False
+        self.finish_load(wait=True)
+        if self.journal:
+            self.journal.close()
+        self.buf = self.hl = self.wrap = None
+        self.screen = []
+        return True
+
+    def memory(self) -> int:
+        """Estimate the bytes held by the loaded lines."""
+        if self.buf is None:
+            return 0
+        if self.measured[0] != (self.version, len(self.buf)):
+            size = self.buf.memory() + len(self.hl.states) + 4 * len(self.wrap.counts)
+            self.measured = ((self.version, len(self.buf)), size)
+        return self.measured[1]
 
     def write(self):
-        with open(self.filename, "w") as fp:
-            fp.write("\n".join(self.buf))
+        """Save a snapshot of the buffer in the background.
+
+        The file is replaced rather than overwritten, so unmodified lines can
+        keep pointing into the old mapping of it.
+        """
+        if not self.filename:
+            self.msg = "no file name"
+            return
+        self.finish_load(wait=True)
+        self.finish_save(wait=True)
+        snapshot, version = self.buf.snapshot(), self.version
+        self.saving = version
+        if self.journal:
+            self.journal.mark()
+        self.msg = "saving..."
+
+        def run():
+            try:
+                save(snapshot, self.filename)
+            except OSError as e:
+                self.msg = f"save failed: {e.strerror or e}"
+            else:
+                self.stat = base(self.filename)
+                self.blocks = Blocks(map_file(self.filename))
+                self.saved = version
+                self.msg = "saved"
+
+        self.saver = threading.Thread(target=run)
+        self.saver.start()
+
+    def finish_save(self, wait: bool = False):
+        """Clean up after a save that has finished, or wait for it."""
+        if self.saver is None or (self.saver.is_alive() and not wait):
+            return
+        self.saver.join()
+        self.saver = None
+        if self.journal:
+            self.journal.rebase(self.saved == self.saving)
+
+    def load(self, pieces, size: int = 0, data=None):
+        """Append the lines `pieces` yields in the background, each with how
+        many of the `size` bytes have been read, then hash `data`, the file
+        they are from, if given.
+
+        Mapped lines start after the last line. Lists of lines, read from a
+        stream, continue it instead, see stream_lines().
+        """
+        self.progress = (0, size)
+
+        def run():
+            for piece in pieces:
+                self.pieces.put(piece)
+            # The end, with the file's Blocks if it has any.
+            self.pieces.put(None if data is None else Blocks(data))
+
+        self.loader = threading.Thread(target=run, daemon=True)
+        self.loader.start()
+
+    def stream(self, fd: int):
+        """Read the lines of the buffer from `fd` as they arrive."""
+        self.load(stream_lines(fd))
+
+    def finish_load(self, wait: bool = False):
+        """Append the lines read in the background so far, or wait for all
+        of them. They are part of the file, not an edit."""
+        while self.loader:
+            try:
+                piece = self.pieces.get(block=wait)
+            except queue.Empty:
+                return
+            if piece is None or isinstance(piece, Blocks):
+                self.loader = None
+                self.blocks = piece
+                # Lines were added without being searched.
+                if self.search and self.search.pattern:
+                    self.search.start(self.buf, self.cy)
+                return
+            lines, done = piece
+            self.progress = (done, self.progress[1])
+            n = len(self.buf)
+            if isinstance(lines, MappedLines):
+                self.buf.extend(lines)
+                start = n
+            else:
+                lines[0] = self.buf[n - 1] + lines[0]
+                self.buf.splice(n - 1, n, lines)
+                start = n - 1
+            self.hl.splice(start, n, len(lines))
+            self.wrap.splice(start, n, len(lines))
+
+    def check_file(self):
+        """Bring the lines up to date with the file if it changed on disk,
+        replacing only the lines that differ from the file as it was read or
+        written. The cursor, scroll position and errors stay with the lines
+        they were on.
+
+        A buffer with unsaved edits is left alone, saving overwrites the file.
+        A file changed in place where lines are read from is read again, see
+        check_mapped().
+        """
+        self.check_mapped()
+        stat = base(self.filename)
+        if self.buf is None or stat == self.stat:
+            return
+        self.stat = stat
+        if stat[0] < 0:
+            self.msg = "file deleted on disk"
+            return
+        if self.version != self.saved:
+            self.msg = "file changed on disk, saving overwrites it"
+            return
+        self.finish_load(wait=True)
+        from watch import diff
+
+        data = map_file(self.filename)
+        splices = diff(self.blocks, self.buf, data)
+        self.blocks = Blocks(data)
+        if not splices:
+            return
+        self.deselect()
+        cy, scroll, sub = self.cy, self.scroll, self.sub
+        # From the bottom up, so the earlier splices' lines stay where they are.
+        for start, stop, lines in reversed(splices):
+            self._splice(start, stop, lines, record=False)
+            end = start + max(len(lines) - 1, 0)
+
+            def shift(y: int) -> int:
+                return y + len(lines) - (stop - start) if y >= stop else min(y, end)
+
+            if start <= scroll < stop:
+                sub = 0
+            cy, scroll = shift(cy), shift(scroll)
+            self.errs = {
+                shift(y): err for y, err in self.errs.items() if not start <= y < stop
+            }
+        self.cy = min(cy, len(self.buf) - 1)
+        self.cx = min(self.cx, len(self.buf[self.cy]))
+        if scroll >= len(self.buf):
+            scroll, sub = len(self.buf) - 1, 0
+        self.scroll, self.sub = scroll, sub
+        # Undo would apply the edits to lines that are gone.
+        self.history = Undo(self.history.budget)
+        self.saved = self.version
+        self.layout()
+        self.follow_cursor()
+        n = sum(max(stop - start, len(lines)) for start, stop, lines in splices)
+        self.msg = f"reloaded from disk, {n} lines changed"
+
+    def use_journal(self, journal: Journal):
+        """Journal edits from now on, after replaying the ones it holds."""
+        n = 0
+        for start, stop, lines in journal.replay():
+            if not n:
+                # The edits are to the whole file.
+                self.finish_load(wait=True)
+            self._splice(start, stop, lines)
+            n += 1
+        if n:
+            self.msg = f"recovered {n} edits"
+        elif journal.stale:
+            self.msg = f"ignored journal for an older file: {journal.path}.stale"
+        self.journal = journal
+        self.check_journal()
+
+    def check_journal(self):
+        """Stop journaling if writing the journal failed."""
+        if self.journal and self.journal.error:
+            self.msg = f"journal failed: {self.journal.error}"
+            self.journal = None
+
+    def redraw(self):
+        """Forget what is on screen so the next render() repaints everything."""
+        self.screen = []
+
+    def gutter(self) -> int:
+        """Return the width of the line numbers and the space after them."""
+        return max(3, len(str(len(self.buf)))) + 1
+
+    def layout(self):
+        self.wrap.resize(term.width - self.gutter() if self.wrapping else 0)
+
+    def toggle_wrap(self):
+        self.wrapping = not self.wrapping
+        self.layout()
+        self.sub = 0
+        self.follow_cursor()
+
+    def resize(self):
+        """Lay the buffer out for a new terminal size, keeping the cursor on
+        screen, and draw all of it again."""
+        self.size = (term.width, term.height)
+        self.layout()
+        self.sub = min(self.sub, self.wrap.rows(self.scroll) - 1)
+        self.follow_cursor()
+        self.redraw()
 
     def render(s):
+        if s.size != (term.width, term.height):
+            s.resize()
+        s.layout()
         render_buffer(
             s.buf, s.cx, s.cy, s.sx1, s.sy1, s.sx2, s.sy2, s.scroll, s.errs, s
         )
 
-    def editor(self):
-        key = term.read()
+    def editor(self, timeout: float = None) -> int:
+        """Apply the keys that arrive within `timeout` seconds.
+
+        Returns how many keys were applied.
+        """
+        keys = term.read(self.wake(timeout))
+        self.check_mapped()
+        for key in keys:
+            self.handle(key)
+        self.poll()
+        return len(keys)
+
+    def wake(self, timeout: float = None) -> Union[float, None]:
+        """Shorten `timeout` to when background work needs a poll()."""
+        for wake in (
+            self.linter and self.linter.timeout(),
+            self.journal and self.journal.timeout(),
+            self.search and self.search.timeout(),
+            0.1 if self.saver else None,
+            0.05 if self.loader else None,
+        ):
+            if wake is not None:
+                timeout = wake if timeout is None else min(timeout, wake)
+        return timeout
+
+    def poll(self):
+        """Pick up the results of background work."""
+        self.finish_load()
+        self.finish_save()
+        if self.search:
+            self.search.poll()
+            if self.seek:
+                self.seek_match()
+        if self.journal:
+            self.journal.flush()
+            self.check_journal()
+        if self.linter and not self.loader:
+            self.lint()
+
+    def lint(self):
+        if self.linter.version != self.version:
+            self.linter.changed(self.version)
+        if self.linter.ready():
+            name = os.path.basename(self.filename or "untitled")
+            self.linter.start(self.version, self.buf.snapshot(), name)
+        result = self.linter.poll()
+        if result and result[0] == self.version:
+            self.errs = result[1]
+
+    def handle(self, key: str):
+        self.history.begin((self.cx, self.cy))
+        try:
+            self.dispatch(key)
+        finally:
+            self.history.end((self.cx, self.cy))
+
+    def dispatch(self, key: str):
+        if self.searching:
+            self.dispatch_search(key)
+            return
+        if isinstance(key, term.Paste):
+            self.insert_text(key)
+            return
         functions = {
             # fmt: off
             # KEY COMBINATION    COMMAND
@@ -99,101 +685,394 @@ class Buffer:
             "LEFT_ARROW":        self.move_cursor_left,
             "CTRL_RIGHT_ARROW":  self.move_cursor_right_wb,
             "CTRL_LEFT_ARROW":   self.move_cursor_left_wb,
+            "ALT_RIGHT_ARROW":   self.move_cursor_right_bigword,
+            "ALT_LEFT_ARROW":    self.move_cursor_left_bigword,
+            "CTRL_UP_ARROW":     self.move_paragraph_up,
+            "CTRL_DOWN_ARROW":   self.move_paragraph_down,
+            "ALT_UP_ARROW":      self.move_indent_up,
+            "ALT_DOWN_ARROW":    self.move_indent_down,
             "UP_ARROW":          self.move_cursor_up,
             "DOWN_ARROW":        self.move_cursor_down,
             "PG_UP":             self.scroll_up,
             "PG_DOWN":           self.scroll_down,
+            "ALT_z":             self.toggle_wrap,
             "HOME":              self.move_cursor_home,
             "END":               self.move_cursor_end,
             "BACKSPACE":         self.delete,
-            "SHIFT_RIGHT_ARROW": self.select_right,
-            "SHIFT_LEFT_ARROW":  self.select_left,
+            "TAB":               self.tab,
+            "SHIFT_TAB":         self.dedent,
+            "CTRL_A":            self.select_all,
+            "CTRL_L":            self.select_line,
+            "CTRL_K":            self.copy,
+            "CTRL_X":            self.cut,
+            "CTRL_V":            self.paste,
+            "CTRL_Z":            self.undo,
+            "CTRL_Y":            self.redo,
+            "CTRL_S":            self.write,
+            "CTRL_F":            self.find,
+            "CTRL_N":            self.find_next,
+            "CTRL_P":            self.find_prev,
+            "ESC":               self.clear_search,
             # fmt: on
         }
+        if key in MOTIONS:
+            self.deselect()
         if key in functions:
             functions[key]()
-        elif term.isascii(key):
+        elif key.replace("SHIFT_", "", 1) in MOTIONS:
+            self.select(functions[key.replace("SHIFT_", "", 1)])
+        elif term.ischar(key):
             self.insert(key)
 
+    def dispatch_search(self, key: str):
+        search = self.search
+        if key == "ESC":
+            self.clear_search()
+            self.cx, self.cy, self.scroll, self.sub = self.origin
+        elif key == "\n":
+            self.searching = False
+        elif key in ("DOWN_ARROW", "CTRL_N"):
+            self.find_next()
+        elif key in ("UP_ARROW", "CTRL_P"):
+            self.find_prev()
+        elif key == "CTRL_R":
+            search.regex = not search.regex
+            self.restart_search()
+        elif key == "BACKSPACE":
+            search.query = search.query[:-1]
+            self.restart_search()
+        elif isinstance(key, term.Paste) or term.ischar(key):
+            search.query += key.split("\n")[0]
+            self.restart_search()
+
+    def find(self):
+        """Start typing a search query, beginning with the last one."""
+        self.deselect()
+        self.searching = True
+        self.origin = (self.cx, self.cy, self.scroll, self.sub)
+        if self.search is None:
+            from search import Search
+
+            self.search = Search()
+        self.restart_search()
+
+    def restart_search(self):
+        self.search.start(self.buf, self.origin[1])
+        self.seek = True
+
+    def seek_match(self):
+        """Move to the first match after where the search started, once the
+        worker has found it."""
+        search = self.search
+        y = search.index.next(self.origin[1] - 1)
+        if y is None and not search.scanning:
+            y = search.index.next(-1)
+        if y is None:
+            if not search.scanning:
+                self.seek = False
+                self.cx, self.cy, self.scroll, self.sub = self.origin
+            return
+        self.seek = False
+        self.cx, self.cy = search.next(self.buf, -1, y) or (0, y)
+        self.follow_cursor()
+
+    def find_next(self):
+        if self.search:
+            self.seek = False
+            self.goto(self.search.next(self.buf, self.cx, self.cy))
+
+    def find_prev(self):
+        if self.search:
+            self.seek = False
+            self.goto(self.search.prev(self.buf, self.cx, self.cy))
+
+    def goto(self, pos):
+        if pos:
+            self.cx, self.cy = pos
+            self.follow_cursor()
+
+    def clear_search(self):
+        self.search = None
+        self.searching = False
+        self.seek = False
+
+    def set_line(self, y: int, line: str):
+        self.splice(y, y + 1, (line,))
+
+    def splice(self, start: int, stop: int, lines=()):
+        """Replace lines start to stop with `lines`, recording it for undo."""
+        lines = list(lines)
+        if self.history.group is not None:
+            self.history.record(start, self.buf.slice(start, stop), lines)
+        self._splice(start, stop, lines)
+
+    def _splice(self, start: int, stop: int, lines: list[str], record: bool = True):
+        if self.journal and record:
+            self.journal.record(start, stop, lines)
+        self.buf.splice(start, stop, lines)
+        self.hl.splice(start, stop, len(lines))
+        self.wrap.splice(start, stop, len(lines))
+        if self.search:
+            self.search.splice(start, stop, lines)
+        self.version += 1
+        # The top of the screen may be gone, or have fewer rows.
+        if self.scroll >= len(self.buf):
+            self.scroll, self.sub = len(self.buf) - 1, 0
+        elif self.sub and start <= self.scroll < stop:
+            self.sub = min(self.sub, self.wrap.rows(self.scroll) - 1)
+
+    def undo(self):
+        group = self.history.undo()
+        if group:
+            self.deselect()
+            for start, old, new in reversed(group.ops):
+                self._splice(start, start + len(new), old)
+            self.cx, self.cy = group.before
+            self.follow_cursor()
+
+    def redo(self):
+        group = self.history.redo()
+        if group:
+            self.deselect()
+            for start, old, new in group.ops:
+                self._splice(start, start + len(old), new)
+            self.cx, self.cy = group.after
+            self.follow_cursor()
+
+    def follow_cursor(self, top: int = 0):
+        """Scroll so that the cursor is on screen, at least `top` rows from
+        the top and 4 rows from the bottom."""
+        cursor = (self.cy, self.wrap.row(self.cy, self.cx))
+        bottom = term.height - 5
+        d = self.wrap.distance((self.scroll, self.sub), cursor, term.height)
+        if d is None or d > bottom:
+            self.scroll, self.sub = self.wrap.back(*cursor, bottom)
+        elif d < top:
+            self.scroll, self.sub = self.wrap.back(*cursor, top)
+
     def cursor_rightbound(self):
         self.cx = min(len(self.buf[self.cy]), self.cx)
 
     def move_cursor_home(self):
         self.cx = 0
+        self.follow_cursor()
 
     def move_cursor_end(self):
         self.cx = len(self.buf[self.cy])
+        self.follow_cursor()
 
     def move_cursor_right(self):
         self.cx = min(len(self.buf[self.cy]), self.cx + 1)
+        self.follow_cursor()
 
     def move_cursor_left(self):
         self.cx = max(0, self.cx - 1)
+        self.follow_cursor()
 
     def move_cursor_left_wb(self):
-        self.move_cursor_left()
-        if self.cx == len(self.buf[self.cy]):
-            return
-        flag = self.buf[self.cy][self.cx].isalnum()
-        while 0 < self.cx and self.buf[self.cy][self.cx].isalnum() == flag:
-            self.move_cursor_left()
+        self.goto(motion.word_left(self.buf, self.cx, self.cy))
 
     def move_cursor_right_wb(self):
-        self.move_cursor_right()
-        if self.cx == len(self.buf[self.cy]):
-            return
-        flag = self.buf[self.cy][self.cx].isalnum()
-        while (
-            self.cx < len(self.buf[self.cy])
-            and self.buf[self.cy][self.cx].isalnum() == flag
-        ):
-            self.move_cursor_right()
+        self.goto(motion.word_right(self.buf, self.cx, self.cy))
+
+    def move_cursor_left_bigword(self):
+        self.goto(motion.word_left(self.buf, self.cx, self.cy, motion.BIGWORD))
+
+    def move_cursor_right_bigword(self):
+        self.goto(motion.word_right(self.buf, self.cx, self.cy, motion.BIGWORD))
+
+    def move_paragraph_up(self):
+        self.goto((0, motion.paragraph_up(self.buf, self.cy)))
+
+    def move_paragraph_down(self):
+        self.goto((0, motion.paragraph_down(self.buf, self.cy)))
+
+    def move_indent_up(self):
+        self.goto(motion.indent(self.buf, self.cy, -1))
+
+    def move_indent_down(self):
+        self.goto(motion.indent(self.buf, self.cy))
 
     def move_cursor_down(self):
-        self.cy = min(len(self.buf) - 1, self.cy + 1)
-        self.cursor_rightbound()
-        if self.cy - term.height + 5 > self.scroll:
-            self.scroll_down()
+        """Move down a row on screen, which may be within the same line,
+        keeping to the same column."""
+        lay = self.wrap.layout(self.cy)
+        sub, x = lay.row(self.cx), lay.x(self.cx)
+        if sub + 1 < lay.rows():
+            self.cx = lay.index(sub + 1, x)
+        elif self.cy + 1 < len(self.buf):
+            self.cy += 1
+            self.cx = self.wrap.layout(self.cy).index(0, x)
+        self.follow_cursor()
 
     def move_cursor_up(self):
-        self.cy = max(0, self.cy - 1)
-        self.cursor_rightbound()
-        if self.cy - 5 < self.scroll:
-            self.scroll_up()
+        lay = self.wrap.layout(self.cy)
+        sub, x = lay.row(self.cx), lay.x(self.cx)
+        if sub:
+            self.cx = lay.index(sub - 1, x)
+        elif self.cy:
+            self.cy -= 1
+            lay = self.wrap.layout(self.cy)
+            self.cx = lay.index(lay.rows() - 1, x)
+        self.follow_cursor(top=5)
 
     def scroll_up(self):
-        self.scroll = max(0, self.scroll - 1)
+        self.scroll, self.sub = self.wrap.back(self.scroll, self.sub, 1)
 
     def scroll_down(self):
-        self.scroll += 1
+        self.scroll, self.sub = self.wrap.forward(self.scroll, self.sub, 1)
 
     def insert(self, c: str):
+        self.delete_selection()
         ln = self.buf[self.cy]
         if c == "\n":
-            right = ln[self.cx :]
-            left = ln[: self.cx]
-            self.buf[self.cy] = right
-            self.buf.insert(self.cy, left)
+            self.splice(self.cy, self.cy + 1, (ln[: self.cx], ln[self.cx :]))
             self.cy += 1
             self.cx = 0
+            self.follow_cursor()
             return
-        self.buf[self.cy] = ln[: self.cx] + c + ln[self.cx:]
+        self.set_line(self.cy, ln[: self.cx] + c + ln[self.cx :])
         self.move_cursor_right()
 
+    def insert_text(self, text: str):
+        """Insert text that may span many lines as a single splice."""
+        self.delete_selection()
+        ln = self.buf[self.cy]
+        lines = text.split("\n")
+        cx = len(lines[-1]) + (self.cx if len(lines) == 1 else 0)
+        lines[0] = ln[: self.cx] + lines[0]
+        lines[-1] += ln[self.cx :]
+        self.splice(self.cy, self.cy + 1, lines)
+        self.cy += len(lines) - 1
+        self.cx = cx
+        self.follow_cursor()
+
     def delete(self):
+        if self.delete_selection():
+            return
         if self.cx == 0:
             if self.cy == 0:
                 return
-            self.cx = len(self.buf[self.cy - 1])
-            self.buf[self.cy - 1] += self.buf.pop(self.cy)
+            prev = self.buf[self.cy - 1]
+            self.cx = len(prev)
+            self.splice(self.cy - 1, self.cy + 1, (prev + self.buf[self.cy],))
             self.cy -= 1
+            self.follow_cursor()
             return
         ln = self.buf[self.cy]
-        self.buf[self.cy] = ln[: self.cx - 1] + ln[self.cx :]
+        self.set_line(self.cy, ln[: self.cx - 1] + ln[self.cx :])
         self.move_cursor_left()
 
-    def select_right(self):
-        ...
+    def selection(self) -> Union[tuple[int, int, int, int], None]:
+        """Return the selected text as (x1, y1, x2, y2), or None if there is
+        none."""
+        if (self.sx1, self.sy1) == (self.sx2, self.sy2):
+            return None
+        return self.sx1, self.sy1, self.sx2, self.sy2
+
+    def set_anchor(self, anchor: Union[tuple[int, int], None]):
+        """Select from `anchor` to the cursor, or nothing if it is None."""
+        self.anchor = anchor
+        if anchor is None:
+            self.sx1 = self.sy1 = self.sx2 = self.sy2 = 0
+            return
+        start, end = sorted(((anchor[1], anchor[0]), (self.cy, self.cx)))
+        (self.sy1, self.sx1), (self.sy2, self.sx2) = start, end
+
+    def deselect(self):
+        self.set_anchor(None)
+
+    def select(self, move):
+        """Move the cursor with `move`, selecting from where it was."""
+        anchor = self.anchor or (self.cx, self.cy)
+        move()
+        self.set_anchor(anchor)
+
+    def select_all(self):
+        self.cy = len(self.buf) - 1
+        self.cx = len(self.buf[self.cy])
+        self.set_anchor((0, 0))
+        self.follow_cursor()
+
+    def select_line(self):
+        """Select the line the cursor is on, or add the next line to a
+        selection of whole lines."""
+        anchor = self.anchor if self.anchor and self.cx == 0 else (0, self.cy)
+        if self.cy + 1 < len(self.buf):
+            self.cx, self.cy = 0, self.cy + 1
+        else:
+            self.cx = len(self.buf[self.cy])
+        self.set_anchor(anchor)
+        self.follow_cursor()
+
+    def selected_text(self) -> str:
+        x1, y1, x2, y2 = self.selection()
+        lines = list(self.buf.lines(y1, y2 + 1))
+        lines[-1] = lines[-1][:x2]
+        lines[0] = lines[0][x1:]
+        return "\n".join(lines)
+
+    def delete_selection(self) -> bool:
+        """Delete the selected text as a single splice. Returns whether
+        anything was selected."""
+        sel = self.selection()
+        self.deselect()
+        if sel is None:
+            return False
+        x1, y1, x2, y2 = sel
+        self.splice(y1, y2 + 1, (self.buf[y1][:x1] + self.buf[y2][x2:],))
+        self.cx, self.cy = x1, y1
+        self.follow_cursor()
+        return True
+
+    def copy(self):
+        if self.selection():
+            Buffer.clipboard = self.selected_text()
+
+    def cut(self):
+        if self.selection():
+            self.copy()
+            self.delete_selection()
+
+    def paste(self):
+        if Buffer.clipboard:
+            self.insert_text(Buffer.clipboard)
+
+    def tab(self):
+        if self.selection():
+            self.indent()
+        else:
+            self.insert_text(" " * (TABSTOP - self.cx % TABSTOP))
+
+    def indent(self, dedent: bool = False):
+        """Indent or dedent the selected lines, or the cursor's line, by one
+        level as a single splice."""
+        sel = self.selection()
+        if sel:
+            # A selection ending at the start of a line leaves that line out.
+            y1, y2 = sel[1], sel[3] - (sel[3] > sel[1] and sel[2] == 0)
+        else:
+            y1 = y2 = self.cy
+        old = list(self.buf.lines(y1, y2 + 1))
+        if dedent:
+            new = []
+            for line in old:
+                n = len(line) - len(line.lstrip(" "))
+                new.append(line[1:] if line[:1] == "\t" else line[min(n, TABSTOP) :])
+        else:
+            new = [INDENT + line if line else line for line in old]
+        if new == old:
+            return
+        self.splice(y1, y2 + 1, new)
+
+        def shift(x: int, y: int) -> tuple[int, int]:
+            if y1 <= y <= y2 and x:
+                x = max(0, x + len(new[y - y1]) - len(old[y - y1]))
+            return x, y
+
+        anchor = self.anchor and shift(*self.anchor)
+        self.cx, self.cy = shift(self.cx, self.cy)
+        self.set_anchor(anchor)
 
-    def select_left(self):
-        ...
+    def dedent(self):
+        self.indent(dedent=True)
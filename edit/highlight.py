@@ -0,0 +1,113 @@
+import re
+from functools import lru_cache
+
+import terminal as term
+
+# Lexer states at the end of a line. Only triple-quoted strings carry over to
+# the next line, everything else ends with the line.
+NORMAL, TRIPLE_DOUBLE, TRIPLE_SINGLE = range(3)
+UNKNOWN = 255
+
+STRING = term.brgreen
+COMMENT = term.brblack
+
+TOKEN = re.compile(r"#|\"\"\"|'''|\"|'")
+CLOSE = {
+    '"': re.compile(r'(?:[^"\\]|\\.)*"'),
+    "'": re.compile(r"(?:[^'\\]|\\.)*'"),
+    '"""': re.compile(r'(?:[^"\\]|\\.|"(?!""))*"""'),
+    "'''": re.compile(r"(?:[^'\\]|\\.|'(?!''))*'''"),
+}
+OPEN = {TRIPLE_DOUBLE: '"""', TRIPLE_SINGLE: "'''"}
+CARRY = {'"""': TRIPLE_DOUBLE, "'''": TRIPLE_SINGLE}
+
+
+@lru_cache(maxsize=4096)
+def lex(line: str, state: int = NORMAL) -> tuple[tuple, int]:
+    """Return the (start, end, color) spans of a line and the state after it.
+
+    Text outside of the spans is drawn in the default color.
+    """
+    spans = []
+    x = 0
+    if state != NORMAL:
+        m = CLOSE[OPEN[state]].match(line)
+        if not m:
+            return ((0, len(line), STRING),), state
+        spans.append((0, m.end(), STRING))
+        x = m.end()
+    while True:
+        m = TOKEN.search(line, x)
+        if not m:
+            return tuple(spans), NORMAL
+        if m[0] == "#":
+            spans.append((m.start(), len(line), COMMENT))
+            return tuple(spans), NORMAL
+        end = CLOSE[m[0]].match(line, m.end())
+        if not end:
+            spans.append((m.start(), len(line), STRING))
+            return tuple(spans), CARRY.get(m[0], NORMAL)
+        spans.append((m.start(), end.end(), STRING))
+        x = end.end()
+
+
+class Highlighter:
+    """Caches the lexer state at the end of every line of a buffer.
+
+    States are computed lazily up to the lines that are asked for. After an
+    edit, lines are re-lexed from the first edited line only until the state
+    at the end of a line matches what it was before the edit.
+    """
+
+    def __init__(self, buf):
+        self.buf = buf
+        # states[:valid] are correct. states[:known] were correct before the
+        # edits since, all of which were on lines up to `dirty`.
+        self.states = bytearray()
+        self.valid = 0
+        self.known = 0
+        self.dirty = -1
+
+    def splice(self, start: int, stop: int, n: int):
+        """Note that lines start to stop were replaced by n lines."""
+        delta = n - (stop - start)
+        if start < len(self.states):
+            self.states[start:stop] = bytes([UNKNOWN]) * n
+        if self.known >= stop:
+            self.known += delta
+        else:
+            self.known = min(self.known, start)
+        if self.dirty >= stop:
+            self.dirty += delta
+        self.dirty = max(self.dirty, start + n - 1, start - 1)
+        self.valid = min(self.valid, start)
+
+    def state(self, y: int) -> int:
+        """Return the lexer state at the start of line y."""
+        if y == 0:
+            return NORMAL
+        self.update(y)
+        return self.states[y - 1]
+
+    def update(self, stop: int):
+        """Make states[:stop] valid."""
+        while self.valid < stop:
+            y = self.valid
+            state = self.states[y - 1] if y else NORMAL
+            if len(self.states) < stop:
+                self.states.extend(bytes([UNKNOWN]) * (stop - len(self.states)))
+            for line in self.buf.lines(y, stop):
+                state = lex(line, state)[1]
+                old = self.states[y]
+                self.states[y] = state
+                y += 1
+                if self.dirty < y <= self.known and old == state:
+                    # The rest of the known lines start in the same state as
+                    # before the edit, so their states are still correct.
+                    self.valid = self.known
+                    self.dirty = -1
+                    break
+            else:
+                self.valid = max(self.valid, y)
+                if y < stop:  # the buffer is shorter than `stop`
+                    return
@@ -0,0 +1,219 @@
+import os
+import struct
+import time
+import zlib
+from typing import Iterator, Union
+
+MAGIC = b"EDJ1"
+# magic, size and mtime_ns of the file the splices apply to.
+HEADER = struct.Struct("<4sqq")
+# Every record is its payload's length and CRC32 followed by the payload,
+# a splice's start, stop and line count followed by the lines.
+RECORD = struct.Struct("<II")
+SPLICE = struct.Struct("<qqI")
+LINE = struct.Struct("<I")
+
+
+def journal_path(filename: str) -> str:
+    directory, name = os.path.split(os.path.abspath(filename))
+    return os.path.join(directory, f".{name}.journal")
+
+
+def base(filename: str) -> tuple[int, int]:
+    """Return (size, mtime_ns) of a file, (-1, 0) if it does not exist."""
+    try:
+        st = os.stat(filename)
+    except FileNotFoundError:
+        return -1, 0
+    return st.st_size, st.st_mtime_ns
+
+
+def write(fd: int, data: bytes):
+    data = memoryview(data)
+    while data:
+        data = data[os.write(fd, data) :]
+
+
+def encode(start: int, stop: int, lines: list[str]) -> bytes:
+    parts = [SPLICE.pack(start, stop, len(lines))]
+    for line in lines:
+        data = line.encode("utf-8", "surrogateescape")
+        parts.append(LINE.pack(len(data)))
+        parts.append(data)
+    payload = b"".join(parts)
+    return RECORD.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def decode(payload: bytes) -> tuple[int, int, list[str]]:
+    start, stop, n = SPLICE.unpack_from(payload)
+    pos = SPLICE.size
+    lines = []
+    for _ in range(n):
+        (size,) = LINE.unpack_from(payload, pos)
+        pos += LINE.size
+        lines.append(payload[pos : pos + size].decode("utf-8", "surrogateescape"))
+        pos += size
+    return start, stop, lines
+
+
+class Journal:
+    """Append-only log of the splices made to a file since it was saved.
+
+    Records are written once per frame and fsynced at most every `interval`
+    seconds. The header holds the size and mtime of the file the splices
+    apply to, so a journal left behind by a crash is only replayed onto the
+    same file. The journal only exists while there are unsaved edits. If it
+    cannot be written, e.g. in a read-only directory, `error` says why and
+    nothing more is journaled.
+    """
+
+    def __init__(self, filename: str, interval: float = 1.0):
+        self.filename = filename
+        self.path = journal_path(filename)
+        self.interval = interval
+        self.fd: Union[int, None] = None
+        self.pending = bytearray()
+        # Records made since mark(), which survive the save that follows it.
+        self.tail: Union[bytearray, None] = None
+        self.dirty = False
+        self.synced = time.monotonic()
+        # Whether replay() found a journal for a different version of the file.
+        self.stale = False
+        self.error: Union[str, None] = None
+
+    def replay(self) -> Iterator[tuple[int, int, list[str]]]:
+        """Yield the (start, stop, lines) splices of a journal left behind.
+
+        A journal for a different version of the file is renamed to
+        "<journal>.stale" and nothing is yielded. A torn record at the end,
+        from a crash during a write, is dropped.
+        """
+        try:
+            with open(self.path, "rb") as fp:
+                data = fp.read()
+        except FileNotFoundError:
+            return
+        if len(data) < HEADER.size or HEADER.unpack_from(data) != (
+            MAGIC,
+            *base(self.filename),
+        ):
+            self.set_aside()
+            return
+        pos = HEADER.size
+        while pos + RECORD.size <= len(data):
+            size, crc = RECORD.unpack_from(data, pos)
+            payload = data[pos + RECORD.size : pos + RECORD.size + size]
+            if len(payload) != size or zlib.crc32(payload) != crc:
+                break
+            yield decode(payload)
+            pos += RECORD.size + size
+        try:
+            self.fd = os.open(self.path, os.O_WRONLY)
+            os.ftruncate(self.fd, pos)
+            os.lseek(self.fd, pos, os.SEEK_SET)
+        except OSError as e:
+            self.fail(e)
+
+    def record(self, start: int, stop: int, lines: list[str]):
+        if self.error:
+            return
+        data = encode(start, stop, lines)
+        self.pending += data
+        if self.tail is not None:
+            self.tail += data
+
+    def timeout(self) -> Union[float, None]:
+        """How long the caller may wait before it should call flush()."""
+        if not self.dirty:
+            return None
+        return max(0.0, self.synced + self.interval - time.monotonic())
+
+    def flush(self, sync: bool = False):
+        """Write the pending records, and fsync if it has been `interval`
+        seconds since the last fsync or `sync` is true."""
+        try:
+            if self.pending:
+                if self.fd is None:
+                    self.fd = self.create(self.path)
+                write(self.fd, self.pending)
+                self.pending.clear()
+                self.dirty = True
+            now = time.monotonic()
+            if self.dirty and (sync or now >= self.synced + self.interval):
+                os.fsync(self.fd)
+                self.dirty = False
+                self.synced = now
+        except OSError as e:
+            self.fail(e)
+
+    def create(self, path: str) -> int:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        write(fd, HEADER.pack(MAGIC, *base(self.filename)))
+        return fd
+
+    def mark(self):
+        """Note that a snapshot of the buffer is being saved."""
+        self.tail = bytearray()
+
+    def rebase(self, saved: bool):
+        """Start over from the file written by the save since mark().
+
+        Only the records made since mark() are kept, if there are none the
+        journal is removed.
+        """
+        tail, self.tail = self.tail, None
+        if not saved or tail is None:
+            return
+        self.pending.clear()
+        self.close()
+        if not tail:
+            self.clear()
+            return
+        tmp = self.path + ".tmp"
+        try:
+            self.fd = self.create(tmp)
+            write(self.fd, tail)
+            os.fsync(self.fd)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            self.fail(e)
+            return
+        self.dirty = False
+
+    def fail(self, e: OSError):
+        """Stop journaling after writing the journal failed."""
+        self.error = e.strerror or str(e)
+        self.pending.clear()
+        self.dirty = False
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def close(self):
+        self.flush(sync=True)
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def set_aside(self) -> bool:
+        """Rename the journal to "<journal>.stale", its splices no longer
+        apply to the file. Returns whether there was a journal to rename."""
+        self.close()
+        try:
+            os.replace(self.path, self.path + ".stale")
+        except FileNotFoundError:
+            return False
+        except OSError as e:
+            self.fail(e)
+            return False
+        self.stale = True
+        return True
+
+    def clear(self):
+        """Remove the journal, the file on disk has every edit."""
+        self.pending.clear()
+        self.close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
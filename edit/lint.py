@@ -0,0 +1,171 @@
+import json
+import os
+import re
+import shlex
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from typing import Callable, Union
+
+# Parsers turn the output of a linter into {line: message}, 0-based lines.
+Parser = Callable[[str], dict[int, str]]
+
+MYPY = r"^[^:\n]*:(?P<line>\d+):(?:\d+:)? (?:error|warning): (?P<message>.*)$"
+FLAKE8 = r"^[^:\n]*:(?P<line>\d+):\d+: (?P<message>.*)$"
+
+
+def regex_parser(pattern: str) -> Parser:
+    """Parse output with a regex that has `line` and `message` groups."""
+    regex = re.compile(pattern, re.MULTILINE)
+
+    def parse(out: str) -> dict[int, str]:
+        errs: dict[int, str] = {}
+        for m in regex.finditer(out):
+            errs.setdefault(int(m["line"]) - 1, m["message"])
+        return errs
+
+    return parse
+
+
+def json_parser(line: str = "location.row", message: str = "message") -> Parser:
+    """Parse a JSON list of diagnostics, fields given as dotted paths."""
+
+    def get(item, path: str):
+        for key in path.split("."):
+            item = item[key]
+        return item
+
+    def parse(out: str) -> dict[int, str]:
+        errs: dict[int, str] = {}
+        try:
+            items = json.loads(out)
+        except ValueError:
+            return errs
+        for item in items:
+            errs.setdefault(int(get(item, line)) - 1, str(get(item, message)))
+        return errs
+
+    return parse
+
+
+PARSERS: dict[str, Parser] = {
+    "mypy": regex_parser(MYPY),
+    "flake8": regex_parser(FLAKE8),
+    "ruff": json_parser(),
+}
+
+
+class Linter:
+    """Runs a linter on buffer snapshots in the background.
+
+    `command` may contain "{file}", which is replaced with the path of a
+    temporary copy of the buffer; without it the text is piped to stdin.
+    "{path}" is replaced with the path of the buffer's own file.
+    A run starts once the buffer has been left alone for `delay` seconds, and
+    a run for an older version is killed as soon as a newer one exists.
+    """
+
+    def __init__(self, command: list[str], parser: Parser, delay: float = 0.5):
+        self.command = command
+        self.parser = parser
+        self.delay = delay
+        self.version = -1
+        self.due: Union[float, None] = None
+        self.lock = threading.Lock()
+        self.proc: Union[subprocess.Popen, None] = None
+        self.running = 0
+        self.result: Union[tuple[int, dict[int, str]], None] = None
+
+    @classmethod
+    def from_env(cls, filename: str) -> Union["Linter", None]:
+        """Build the linter configured by EDIT_LINT and EDIT_LINT_FORMAT.
+
+        EDIT_LINT is the command, mypy for Python files by default, checking
+        the buffer in place of its file so that the project's modules and
+        configuration are used. EDIT_LINT_FORMAT is a name in PARSERS or a
+        regex for regex_parser(). There is no linter if the command is not
+        installed.
+        """
+        command = os.environ.get("EDIT_LINT")
+        if command is None and filename.endswith(".py"):
+            if os.path.exists(filename):
+                command = "mypy --shadow-file {path} {file} {path}"
+            else:
+                command = "mypy {file}"
+        if not command:
+            return None
+        args = shlex.split(command)
+        if not shutil.which(args[0]):
+            return None
+        fmt = os.environ.get("EDIT_LINT_FORMAT", args[0])
+        parser = PARSERS.get(fmt) or regex_parser(fmt if "(?P<" in fmt else MYPY)
+        return cls([arg.replace("{path}", filename) for arg in args], parser)
+
+    def changed(self, version: int):
+        """Note that the buffer is now at `version`."""
+        self.version = version
+        self.due = time.monotonic() + self.delay
+        with self.lock:
+            if self.proc:
+                self.proc.kill()
+
+    def timeout(self) -> Union[float, None]:
+        """How long the caller may wait before it should call poll()."""
+        if self.due is not None:
+            return max(0.0, self.due - time.monotonic())
+        if self.running:
+            return 0.1
+        return None
+
+    def ready(self) -> bool:
+        return self.due is not None and time.monotonic() >= self.due
+
+    def start(self, version: int, snapshot, name: str):
+        """Lint a snapshot() of the buffer, which is only read in the
+        background thread."""
+        self.due = None
+        with self.lock:
+            self.running += 1
+        threading.Thread(
+            target=self.run, args=(version, snapshot, name), daemon=True
+        ).start()
+
+    def run(self, version: int, snapshot, name: str):
+        try:
+            data = b"".join(snapshot.encode())
+            with tempfile.TemporaryDirectory() as tmp:
+                path = os.path.join(tmp, name)
+                with open(path, "wb") as fp:
+                    fp.write(data)
+                stdin = not any("{file}" in arg for arg in self.command)
+                args = [arg.replace("{file}", path) for arg in self.command]
+                with self.lock:
+                    if version != self.version:
+                        return
+                    try:
+                        self.proc = subprocess.Popen(
+                            args,
+                            stdin=subprocess.PIPE if stdin else subprocess.DEVNULL,
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT,
+                        )
+                    except OSError:
+                        return
+                    proc = self.proc
+                out, _ = proc.communicate(data if stdin else None)
+                with self.lock:
+                    self.proc = None
+                    if version == self.version and proc.returncode >= 0:
+                        errs = self.parser(out.decode(errors="replace"))
+                        self.result = version, errs
+        finally:
+            with self.lock:
+                self.running -= 1
+
+    def poll(self) -> Union[tuple[int, dict[int, str]], None]:
+        """Return (version, errors) of a finished run, if there is one."""
+        with self.lock:
+            result, self.result = self.result, None
+        return result
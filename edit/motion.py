@@ -0,0 +1,81 @@
+import re
+from typing import Union
+
+# Lines joined and searched at a time when looking for a line.
+CHUNK = 1024
+
+# A word is a run of word characters or a run of other non-blank characters,
+# a WORD is any run of non-blank characters. Both patterns read the same
+# backwards, so they also find words in a reversed line.
+WORD = re.compile(r"\s*(?:\w+|[^\w\s]+)")
+BIGWORD = re.compile(r"\s*\S+")
+BLANK = re.compile(r"^[ \t]*$", re.MULTILINE)
+TEXT = re.compile(r"\S")
+INDENT = re.compile(r"[ \t]*")
+
+
+def find_line(buf, y: int, pattern: re.Pattern, step: int = 1) -> Union[int, None]:
+    """Return the first line from y on that `pattern` matches, or the last
+    one from y back if step is -1. Lines are searched in joined chunks, the
+    patterns only ever match within a line."""
+    while 0 <= y < len(buf):
+        if step > 0:
+            chunk = list(buf.lines(y, y + CHUNK))
+        else:
+            # Reversed, so that the first match is on the last line.
+            chunk = list(buf.lines(max(0, y - CHUNK + 1), y + 1))[::-1]
+        text = "\n".join(chunk)
+        m = pattern.search(text)
+        if m:
+            return y + step * text.count("\n", 0, m.start())
+        y += step * len(chunk)
+    return None
+
+
+def word_right(buf, x: int, y: int, pattern=WORD) -> tuple[int, int]:
+    """Return the end of the word after (x, y), which may be on a later line."""
+    m = pattern.match(buf[y], x)
+    if m:
+        return m.end(), y
+    y = find_line(buf, y + 1, TEXT)
+    if y is None:
+        return len(buf[len(buf) - 1]), len(buf) - 1
+    return pattern.match(buf[y]).end(), y
+
+
+def word_left(buf, x: int, y: int, pattern=WORD) -> tuple[int, int]:
+    """Return the start of the word before (x, y), which may be on an earlier
+    line."""
+    m = pattern.match(buf[y][:x][::-1])
+    if m:
+        return x - m.end(), y
+    y = find_line(buf, y - 1, TEXT, -1)
+    if y is None:
+        return 0, 0
+    line = buf[y]
+    return len(line) - pattern.match(line[::-1]).end(), y
+
+
+def paragraph_down(buf, y: int) -> int:
+    """Return the blank line after the paragraph at or after line y."""
+    y = find_line(buf, y, TEXT)
+    if y is not None:
+        y = find_line(buf, y + 1, BLANK)
+    return len(buf) - 1 if y is None else y
+
+
+def paragraph_up(buf, y: int) -> int:
+    """Return the blank line before the paragraph at or before line y."""
+    y = find_line(buf, y, TEXT, -1)
+    if y is not None:
+        y = find_line(buf, y - 1, BLANK, -1)
+    return 0 if y is None else y
+
+
+def indent(buf, y: int, step: int = 1) -> Union[tuple[int, int], None]:
+    """Return the start of the text on the next line (or the previous one if
+    step is -1) indented exactly like line y."""
+    prefix = INDENT.match(buf[y])[0]
+    pattern = re.compile("^" + re.escape(prefix) + r"(?=\S)", re.MULTILINE)
+    y = find_line(buf, y + step, pattern, step)
+    return None if y is None else (len(prefix), y)
@@ -0,0 +1,276 @@
+import bisect
+import queue
+import re
+import threading
+import time
+from itertools import islice
+from typing import Union
+
+# Lines the worker joins and searches at a time.
+CHUNK = 4096
+# Seconds poll() may spend merging the worker's results per call.
+POLL_BUDGET = 0.005
+
+
+class MatchIndex:
+    """Sorted set of line numbers, kept in blocks that each carry a shift.
+
+    An edit adds its line delta to the shift of every block after it, so it
+    costs O(blocks) instead of O(matches). Lookups are O(log n).
+    """
+
+    BLOCK = 512
+
+    def __init__(self):
+        self.blocks: list[list[int]] = []
+        self.shifts: list[int] = []
+        self.count = 0
+
+    def __len__(self) -> int:
+        return self.count
+
+    def _find(self, y: int) -> int:
+        """Return the last block starting at or before line y, or -1."""
+        lo, hi = 0, len(self.blocks)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.blocks[mid][0] + self.shifts[mid] <= y:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo - 1
+
+    def add(self, y: int):
+        if not self.blocks:
+            self.blocks.append([y])
+            self.shifts.append(0)
+            self.count = 1
+            return
+        i = max(0, self._find(y))
+        block, shift = self.blocks[i], self.shifts[i]
+        j = bisect.bisect_left(block, y - shift)
+        if j < len(block) and block[j] == y - shift:
+            return
+        block.insert(j, y - shift)
+        self.count += 1
+        if len(block) > 2 * self.BLOCK:
+            self.blocks[i : i + 1] = [block[: self.BLOCK], block[self.BLOCK :]]
+            self.shifts.insert(i, shift)
+
+    def update(self, lines: list[int]):
+        """Add sorted lines, as whole blocks when no line already in the
+        index falls between them."""
+        if not lines:
+            return
+        i = self._find(lines[0])
+        if i + 1 < len(self.blocks):
+            if self.blocks[i + 1][0] + self.shifts[i + 1] <= lines[-1]:
+                for y in lines:
+                    self.add(y)
+                return
+        if i >= 0:
+            block, shift = self.blocks[i], self.shifts[i]
+            if block[-1] + shift >= lines[0]:
+                for y in lines:
+                    self.add(y)
+                return
+            if len(block) + len(lines) <= 2 * self.BLOCK:
+                block.extend(y - shift for y in lines)
+                self.count += len(lines)
+                return
+        blocks = [lines[k : k + self.BLOCK] for k in range(0, len(lines), self.BLOCK)]
+        self.blocks[i + 1 : i + 1] = blocks
+        self.shifts[i + 1 : i + 1] = [0] * len(blocks)
+        self.count += len(lines)
+
+    def splice(self, start: int, stop: int, n: int):
+        """Forget lines start to stop and shift the ones after by the number
+        of lines that replaced them."""
+        delta = n - (stop - start)
+        i = max(0, self._find(start))
+        while i < len(self.blocks):
+            block, shift = self.blocks[i], self.shifts[i]
+            if block[-1] + shift < start:
+                pass
+            elif block[0] + shift >= stop:
+                self.shifts[i] += delta
+            else:
+                lo = bisect.bisect_left(block, start - shift)
+                hi = bisect.bisect_left(block, stop - shift)
+                self.count -= hi - lo
+                block[lo:] = [y + delta for y in block[hi:]]
+                if not block:
+                    del self.blocks[i], self.shifts[i]
+                    continue
+            i += 1
+
+    def next(self, y: int) -> Union[int, None]:
+        """Return the first line after y."""
+        i = self._find(y)
+        if i >= 0:
+            block, shift = self.blocks[i], self.shifts[i]
+            j = bisect.bisect_right(block, y - shift)
+            if j < len(block):
+                return block[j] + shift
+        if i + 1 < len(self.blocks):
+            return self.blocks[i + 1][0] + self.shifts[i + 1]
+        return None
+
+    def prev(self, y: int) -> Union[int, None]:
+        """Return the last line before y."""
+        i = self._find(y - 1)
+        if i < 0:
+            return None
+        block, shift = self.blocks[i], self.shifts[i]
+        return block[bisect.bisect_left(block, y - shift) - 1] + shift
+
+
+def matching(pattern: re.Pattern, lines: list[str]) -> list[int]:
+    """Return the indices of the lines that `pattern` matches."""
+    # Searching the joined lines is much faster than a search per line when
+    # matches are sparse. A match that spans lines is checked against its
+    # first line on its own.
+    text = "\n".join(lines)
+    found = []
+    y = last = 0
+    m = pattern.search(text)
+    while m:
+        y += text.count("\n", last, m.start())
+        if "\n" not in m[0] or pattern.search(lines[y]):
+            found.append(y)
+        end = text.find("\n", m.start())
+        if end < 0:
+            break
+        last = end + 1
+        y += 1
+        m = pattern.search(text, last)
+    return found
+
+
+class Search:
+    """The lines of a buffer that match a query, found in the background.
+
+    A worker scans a snapshot of the buffer from the cursor onwards and then
+    from the top, in chunks. Edits made meanwhile are applied to the index
+    right away, and to the worker's results as they are merged.
+    """
+
+    def __init__(self, query: str = "", regex: bool = False):
+        self.query = query
+        self.regex = regex
+        self.pattern: Union[re.Pattern, None] = None
+        self.error = ""
+        self.index = MatchIndex()
+        self.generation = 0
+        self.results: queue.SimpleQueue = queue.SimpleQueue()
+        # Splices made since the worker's snapshot, as (start, stop, n).
+        self.edits: list[tuple[int, int, int]] = []
+        self.scanning = False
+
+    def start(self, buf, y: int = 0):
+        """Search `buf` for the query, starting at line y."""
+        self.generation += 1
+        self.index = MatchIndex()
+        self.edits = []
+        self.scanning = False
+        self.pattern = None
+        self.error = ""
+        if not self.query:
+            return
+        try:
+            source = self.query if self.regex else re.escape(self.query)
+            self.pattern = re.compile(source, re.MULTILINE)
+        except re.error as e:
+            self.error = str(e)
+            return
+        self.scanning = True
+        threading.Thread(
+            target=self.scan,
+            args=(self.generation, self.pattern, buf.snapshot(), y),
+            daemon=True,
+        ).start()
+
+    def scan(self, generation: int, pattern: re.Pattern, snapshot, y: int):
+        for start, stop in ((y, len(snapshot)), (0, y)):
+            lines = snapshot.lines(start, stop)
+            while self.generation == generation:
+                chunk = list(islice(lines, CHUNK))
+                if not chunk:
+                    break
+                found = [start + i for i in matching(pattern, chunk)]
+                self.results.put((generation, found))
+                start += len(chunk)
+        self.results.put((generation, None))
+
+    def poll(self):
+        """Merge the results the worker has found so far."""
+        deadline = time.monotonic() + POLL_BUDGET
+        while time.monotonic() < deadline:
+            try:
+                generation, found = self.results.get_nowait()
+            except queue.Empty:
+                return
+            if generation != self.generation:
+                continue
+            if found is None:
+                self.scanning = False
+                self.edits = []
+                continue
+            for start, stop, n in self.edits:
+                delta = n - (stop - start)
+                found = [
+                    y if y < start else y + delta
+                    for y in found
+                    if not start <= y < stop
+                ]
+            self.index.update(found)
+
+    def timeout(self) -> Union[float, None]:
+        """How long the caller may wait before it should call poll()."""
+        return 0.05 if self.scanning else None
+
+    def splice(self, start: int, stop: int, lines: list[str]):
+        if self.pattern is None:
+            return
+        self.index.splice(start, stop, len(lines))
+        if self.scanning:
+            self.edits.append((start, stop, len(lines)))
+        for y, line in enumerate(lines, start):
+            if self.pattern.search(line):
+                self.index.add(y)
+
+    def spans(self, line: str) -> tuple[tuple[int, int], ...]:
+        """Return the (start, end) columns of the matches in a line."""
+        if self.pattern is None:
+            return ()
+        return tuple(m.span() for m in self.pattern.finditer(line) if m[0])
+
+    def next(self, buf, x: int, y: int) -> Union[tuple[int, int], None]:
+        """Return the first match after column x of line y, wrapping around."""
+        if self.pattern is None:
+            return None
+        m = self.pattern.search(buf[y], x + 1) if x < len(buf[y]) else None
+        if m:
+            return m.start(), y
+        found = self.index.next(y)
+        if found is None:
+            found = self.index.next(-1)
+        if found is None:
+            return None
+        m = self.pattern.search(buf[found])
+        return (m.start() if m else 0), found
+
+    def prev(self, buf, x: int, y: int) -> Union[tuple[int, int], None]:
+        """Return the last match before column x of line y, wrapping around."""
+        if self.pattern is None:
+            return None
+        starts = [m.start() for m in self.pattern.finditer(buf[y]) if m.start() < x]
+        if starts:
+            return starts[-1], y
+        found = self.index.prev(y)
+        if found is None:
+            found = self.index.prev(len(buf))
+        if found is None:
+            return None
+        starts = [m.start() for m in self.pattern.finditer(buf[found])]
+        return (starts[-1] if starts else 0), found
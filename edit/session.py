@@ -0,0 +1,204 @@
+import sys
+from typing import TYPE_CHECKING, Union
+import terminal as term
+import timing
+from buffer import SELECTED, Buffer
+from journal import Journal
+from wrap import fit
+
+if TYPE_CHECKING:
+    from watch import Watcher
+
+
+class Session:
+    """The open buffers, one of which is shown.
+
+    Buffers are loaded when they are first shown. The loaded buffers that are
+    not shown share `budget` bytes; past it the least recently shown ones are
+    unloaded, to be loaded again from their file and journal. A file named
+    "-" is read from stdin as it arrives. Files changed on disk are reloaded
+    into the buffers that have them loaded, see Buffer.check_file().
+    """
+
+    def __init__(
+        self,
+        filenames: list[str],
+        budget: int = 256 << 20,
+        journal: bool = True,
+        undo_budget: int = 64 << 20,
+    ):
+        self.budget = budget
+        self.journal = journal
+        self.undo_budget = undo_budget
+        self.buffers = [self.open(name) for name in filenames] or [Buffer()]
+        # Loaded buffers, the one shown last.
+        self.recent: list[Buffer] = []
+        self.current = self.buffers[0]
+        # Loaded buffers whose linter is set up after the next frame.
+        self.unlinted: list[Buffer] = []
+        # Watches the files from the first frame on.
+        self.watcher: Union["Watcher", None] = None
+        # Files that changed on disk, checked once their buffer is not saving.
+        self.changed: set[str] = set()
+        self.listing = False
+        self.selected = 0
+        self.show(0)
+
+    def open(self, filename: str) -> Buffer:
+        if filename != "-":
+            return Buffer(filename, lazy=True)
+        buffer = Buffer()
+        buffer.stream(sys.stdin.fileno())
+        return buffer
+
+    def show(self, i: int):
+        buffer = self.buffers[i]
+        if buffer.buf is None:
+            self.load(buffer)
+        if buffer in self.recent:
+            self.recent.remove(buffer)
+        self.recent.append(buffer)
+        self.current = buffer
+        buffer.redraw()
+        self.evict()
+
+    def load(self, buffer: Buffer):
+        msg, version, stat = buffer.msg, buffer.version, buffer.stat
+        buffer.reload()
+        if self.journal:
+            journal = Journal(buffer.filename)
+            buffer.use_journal(journal)
+            if version and not (journal.stale or journal.error):
+                # Unloaded earlier, the journal holds this session's edits.
+                buffer.msg = msg
+        if buffer.stat != stat:
+            # Changed on disk since it was unloaded, or never loaded.
+            buffer.forget()
+        if buffer.linter is None:
+            self.unlinted.append(buffer)
+        buffer.history.budget = self.undo_budget
+
+    def evict(self):
+        """Unload the least recently shown buffers until the ones in the
+        background fit in the budget."""
+        background = self.recent[:-1]
+        total = sum(buffer.memory() for buffer in background)
+        for buffer in background:
+            if total <= self.budget:
+                break
+            size = buffer.memory()
+            if buffer.unload():
+                self.recent.remove(buffer)
+                total -= size
+
+    def switch(self, step: int):
+        self.show((self.buffers.index(self.current) + step) % len(self.buffers))
+
+    def render(self):
+        # However many resizes there were since the last frame, the buffer
+        # is laid out again once, when it is rendered.
+        term.resize()
+        if self.listing:
+            self.render_list()
+        else:
+            self.current.render()
+
+    def render_list(self):
+        rows = term.height - 1
+        top = max(0, self.selected - rows + 1)
+        for row in range(rows):
+            i = top + row
+            term.m(0, row)
+            if i < len(self.buffers):
+                buffer = self.buffers[i]
+                modified = "*" if buffer.version != buffer.saved else ""
+                lines = "-" if buffer.buf is None else len(buffer.buf)
+                text = f" {buffer.filename or 'untitled'}{modified}  {lines} lines"
+                text = fit(text, term.width)
+                term.w(SELECTED + text + term.reset if i == self.selected else text)
+            else:
+                term.w("\u001b[K")
+        term.m(0, rows)
+        loaded = sum(buffer.memory() for buffer in self.recent) >> 20
+        status = f" -- BUFFERS --  {len(self.buffers)} open  {loaded} MiB loaded"
+        term.w(term.bgwhite + term.black + fit(status, term.width))
+        term.w(term.reset)
+        term.m(0, self.selected - top)
+        term.f()
+
+    def editor(self, timeout: float = None) -> int:
+        """Apply the keys that arrive within `timeout` seconds to the session
+        and the shown buffer. Returns how many keys were applied."""
+        timeout = self.current.wake(timeout)
+        if any(buffer.saver for buffer in self.buffers):
+            timeout = 0.1 if timeout is None else min(timeout, 0.1)
+        if self.watcher:
+            wake = self.watcher.timeout()
+            timeout = wake if timeout is None else min(timeout, wake)
+        keys = term.read(timeout)
+        # Before anything reads the lines of a file changed in place.
+        for buffer in self.recent:
+            buffer.check_mapped()
+        for key in keys:
+            self.handle(key)
+        if timing.profiler:
+            timing.profiler.mark("dispatch", len(keys))
+        for buffer in self.buffers:
+            buffer.finish_save()
+        if self.unlinted:
+            from lint import Linter
+
+            for buffer in self.unlinted:
+                buffer.linter = Linter.from_env(buffer.filename)
+            self.unlinted.clear()
+        self.check_files()
+        self.current.poll()
+        if timing.profiler:
+            timing.profiler.mark("poll")
+        return len(keys)
+
+    def check_files(self):
+        if self.watcher is None:
+            from watch import Watcher
+
+            names = [buffer.filename for buffer in self.buffers if buffer.filename]
+            self.watcher = Watcher(names)
+        self.changed |= self.watcher.changed()
+        for buffer in self.buffers:
+            if buffer.filename in self.changed and not buffer.saver:
+                self.changed.discard(buffer.filename)
+                buffer.check_file()
+
+    def handle(self, key: str):
+        if self.listing:
+            self.dispatch_list(key)
+        elif key == "CTRL_B":
+            self.listing = True
+            self.selected = self.buffers.index(self.current)
+        elif key == "CTRL_PG_DOWN":
+            self.switch(1)
+        elif key == "CTRL_PG_UP":
+            self.switch(-1)
+        else:
+            self.current.handle(key)
+
+    def dispatch_list(self, key: str):
+        if key == "UP_ARROW":
+            self.selected = max(0, self.selected - 1)
+        elif key == "DOWN_ARROW":
+            self.selected = min(len(self.buffers) - 1, self.selected + 1)
+        elif key == "\n":
+            self.listing = False
+            self.show(self.selected)
+        elif key in ("ESC", "CTRL_B"):
+            self.listing = False
+            self.current.redraw()
+
+    def close(self):
+        """Finish saves and flush journals before exiting."""
+        for buffer in self.buffers:
+            buffer.finish_save(wait=True)
+            if buffer.journal:
+                buffer.journal.close()
+        if self.watcher:
+            self.watcher.close()
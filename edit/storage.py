@@ -0,0 +1,570 @@
+import mmap
+import os
+import stat
+import zlib
+from array import array
+from itertools import accumulate
+from typing import Iterable, Iterator, Union
+
+# Leaves hold at most LEAF_MAX lines and internal nodes at most KIDS_MAX
+# children. Overflowing nodes are split into pieces of half that size, and
+# nodes smaller than a quarter of it are merged into a neighbour.
+LEAF_MAX = 1024
+KIDS_MAX = 64
+# Rough per-line overhead of a str, in bytes.
+LINE_OVERHEAD = 56
+
+
+def cost(lines: list[str]) -> int:
+    """Estimate the memory held by decoded lines."""
+    return sum(map(len, lines)) + LINE_OVERHEAD * len(lines)
+
+
+def index_lines(data, pos: int = 0, stop: int = None) -> array:
+    """Return the start offset of every line in data[pos:], plus an end
+    sentinel. With `stop`, which must follow a newline, only the lines before
+    it are indexed and it is the sentinel."""
+    offsets = array("q", [pos])
+    inc = (1).__add__
+    end = len(data) if stop is None else stop
+    while pos < end:
+        chunk = data[pos : min(end, pos + (1 << 22))]
+        parts = chunk.split(b"\n")
+        parts.pop()
+        # Every part before the last ended with a newline, so the running sum
+        # of (length + 1) gives the offset of each following line.
+        ends = accumulate(map(inc, map(len, parts)), initial=pos)
+        next(ends)
+        offsets.extend(ends)
+        pos += len(chunk)
+    if stop is None:
+        offsets.append(len(data) + 1)
+    return offsets
+
+
+# Bytes per block hashed by Blocks.
+BLOCK = 1 << 16
+
+
+class Blocks:
+    """The size of a file and the CRC32s of its BLOCK-byte blocks.
+
+    They tell how much of its start and end a new version of the file shares
+    without keeping the old bytes around, see watch.diff().
+    """
+
+    __slots__ = ("size", "crcs")
+
+    def __init__(self, data):
+        self.size = len(data)
+        self.crcs = array(
+            "I", (zlib.crc32(data[i : i + BLOCK]) for i in range(0, len(data), BLOCK))
+        )
+
+
+def map_file(filename: str):
+    """Map a file read-only. Files that cannot be mapped, like empty ones
+    and those in /proc, are read instead."""
+    with open(filename, "rb") as fp:
+        st = os.fstat(fp.fileno())
+        if not stat.S_ISREG(st.st_mode) or not st.st_size:
+            return fp.read()
+        return mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class MappedLines:
+    """Read-only view of the lines of a memory-mapped file.
+
+    Only the compact offset index is built up front. Lines are decoded when
+    they are looked up, and slicing returns a view sharing the same index.
+    """
+
+    __slots__ = ("data", "offsets", "start", "stop", "crlf")
+
+    def __init__(
+        self, data, offsets: array, start: int = 0, stop: int = None, crlf=None
+    ):
+        self.data = data
+        self.offsets = offsets
+        self.start = start
+        self.stop = len(offsets) - 1 if stop is None else stop
+        if crlf is None:
+            crlf = data.find(b"\r", offsets[self.start], offsets[self.stop]) >= 0
+        # Whether lines may end in "\r", which decoding strips.
+        self.crlf = crlf
+
+    @classmethod
+    def open(cls, filename: str, head: int = 0) -> "MappedLines":
+        """Map a file and index its lines. With `head`, only the lines that
+        end in its first `head` bytes are indexed, rest() indexes the others."""
+        data = map_file(filename)
+        stop = data.rfind(b"\n", 0, head) + 1 if head < len(data) else 0
+        return cls(data, index_lines(data, 0, stop) if stop else index_lines(data))
+
+    def complete(self) -> bool:
+        """Whether these lines run to the end of the file."""
+        return self.offsets[-1] > len(self.data)
+
+    def rest(self, size: int = 1 << 24) -> Iterator["MappedLines"]:
+        """Index the lines of the file after the ones open() indexed, in
+        pieces of about `size` bytes."""
+        data, pos = self.data, self.offsets[-1]
+        while pos <= len(data):
+            stop = data.find(b"\n", pos + size) + 1
+            if not stop:
+                yield MappedLines(data, index_lines(data, pos))
+                return
+            yield MappedLines(data, index_lines(data, pos, stop))
+            pos = stop
+
+    def __len__(self) -> int:
+        return self.stop - self.start
+
+    def __getitem__(self, y: Union[int, slice]):
+        if isinstance(y, slice):
+            start, stop, _ = y.indices(len(self))
+            return MappedLines(
+                self.data,
+                self.offsets,
+                self.start + start,
+                self.start + stop,
+                self.crlf,
+            )
+        if y < 0:
+            y += len(self)
+        if not 0 <= y < len(self):
+            raise IndexError("line index out of range")
+        y += self.start
+        line = self.data[self.offsets[y] : self.offsets[y + 1] - 1]
+        if line.endswith(b"\r"):
+            line = line[:-1]
+        return line.decode("utf-8", "surrogateescape")
+
+    def __iter__(self) -> Iterator[str]:
+        for y in range(len(self)):
+            yield self[y]
+
+    def encode(self) -> bytes:
+        """Return the lines joined by newlines, as they are in the file."""
+        if self.crlf:
+            return "\n".join(self).encode("utf-8", "surrogateescape")
+        return self.data[self.offsets[self.start] : self.offsets[self.stop] - 1]
+
+
+def stream_lines(fd: int, size: int = 1 << 20) -> Iterator[tuple[list[str], int]]:
+    """Read `fd` to its end, yielding the lines read so far as they arrive,
+    and how many bytes have been read in total.
+
+    Every batch but the last ends with a newline, so its last line is "". The
+    first line of a batch continues that line.
+    """
+    pending = b""
+    total = 0
+    while data := os.read(fd, size):
+        total += len(data)
+        data = pending + data
+        cut = data.rfind(b"\n") + 1
+        pending = data[cut:]
+        if cut:
+            yield split_lines(data[:cut]), total
+    if pending:
+        yield split_lines(pending), total
+
+
+def split_lines(data: bytes) -> list[str]:
+    lines = data.decode("utf-8", "surrogateescape").split("\n")
+    if b"\r" in data:
+        lines = [line[:-1] if line.endswith("\r") else line for line in lines]
+    return lines
+
+
+def save(lines, filename: str):
+    """Atomically replace `filename` with `lines` joined by newlines.
+
+    `lines` must not change while this runs, use a snapshot(). The text is
+    streamed to a temporary file in the same directory, synced to disk and
+    renamed over `filename`, so a crash leaves either the old or the new file.
+    A symlink is followed, replacing the file it points to.
+    """
+    import tempfile
+
+    filename = os.path.realpath(filename)
+    directory = os.path.dirname(filename)
+    name = os.path.basename(filename)
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=f".{name}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb", buffering=1 << 20) as fp:
+            for chunk in lines.encode():
+                fp.write(chunk)
+            fp.flush()
+            os.fsync(fp.fileno())
+        try:
+            mode = stat.S_IMODE(os.stat(filename).st_mode)
+        except FileNotFoundError:
+            umask = os.umask(0)
+            os.umask(umask)
+            mode = 0o666 & ~umask
+        os.chmod(tmp, mode)
+        os.replace(tmp, filename)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class ListStorage(list):
+    """The plain `list[str]` storage, O(n) line inserts and deletes."""
+
+    def lines(self, start: int = 0, stop: int = None) -> Iterator[str]:
+        return iter(self[start:stop])
+
+    def splice(self, start: int, stop: int, lines: Iterable[str] = ()):
+        self[start:stop] = lines
+
+    def memory(self) -> int:
+        return cost(self)
+
+    def mapped(self) -> Iterator[MappedLines]:
+        return iter(())
+
+    def slice(self, start: int, stop: int) -> list[str]:
+        return self[start:stop]
+
+    def snapshot(self) -> "ListStorage":
+        return ListStorage(self)
+
+    def encode(self) -> Iterator[bytes]:
+        for y in range(0, len(self), LEAF_MAX):
+            if y:
+                yield b"\n"
+            yield "\n".join(self[y : y + LEAF_MAX]).encode("utf-8", "surrogateescape")
+
+
+class _Leaf:
+    __slots__ = ("items", "size", "shared")
+
+    def __init__(self, items: Union[list[str], MappedLines]):
+        self.items = items
+        self.size = len(items)
+        # Whether a snapshot uses the same items.
+        self.shared = False
+
+    def own(self) -> list[str]:
+        """Return items as a list of lines this leaf can modify, copying them
+        if they are mapped or shared with a snapshot."""
+        if self.shared or type(self.items) is not list:
+            self.items = list(self.items)
+            self.shared = False
+        return self.items
+
+
+class _Node:
+    __slots__ = ("kids", "size")
+
+    def __init__(self, kids: list):
+        self.kids = kids
+        self.size = sum(kid.size for kid in kids)
+
+
+def _width(node) -> int:
+    return len(node.items) if type(node) is _Leaf else len(node.kids)
+
+
+def _limit(node) -> int:
+    return LEAF_MAX if type(node) is _Leaf else KIDS_MAX
+
+
+def _chunks(items: list, limit: int) -> list[list]:
+    n = -(-len(items) // (limit // 2))
+    step = -(-len(items) // n)
+    return [items[i : i + step] for i in range(0, len(items), step)]
+
+
+def _build(items: list, limit: int, cls) -> list:
+    if len(items) <= limit:
+        return [cls(items)]
+    return [cls(chunk) for chunk in _chunks(items, limit)]
+
+
+def _split(node) -> list:
+    if _width(node) <= _limit(node):
+        return [node]
+    if type(node) is _Leaf:
+        return _build(node.items, LEAF_MAX, _Leaf)
+    return _build(node.kids, KIDS_MAX, _Node)
+
+
+def _merge(a, b) -> list:
+    if type(a) is _Leaf:
+        return _split(_Leaf(a.own() + b.own()))
+    return _split(_Node(a.kids + b.kids))
+
+
+def _stack(level: list):
+    """Return the root of the nodes built above a level of leaves."""
+    level = [leaf for leaf in level if leaf.size] or [_Leaf([])]
+    while len(level) > 1:
+        level = _build(level, KIDS_MAX, _Node)
+    return level[0]
+
+
+def _share(leaf: _Leaf) -> _Leaf:
+    """Return a leaf with the same items, which neither leaf modifies."""
+    leaf.shared = True
+    copy = _Leaf(leaf.items)
+    copy.shared = True
+    return copy
+
+
+def _normalize(node: _Node):
+    """Drop empty children, split overflowing ones and merge small ones."""
+    kids = []
+    for kid in node.kids:
+        if not kid.size:
+            continue
+        if kids and _width(kid) + _width(kids[-1]) <= _limit(kid) and (
+            _width(kid) < _limit(kid) // 4 or _width(kids[-1]) < _limit(kid) // 4
+        ):
+            kids[-1:] = _merge(kids[-1], kid)
+        else:
+            kids.extend(_split(kid))
+    node.kids = kids
+    node.size = sum(kid.size for kid in kids)
+
+
+class Rope:
+    """Balanced tree of line chunks with line-count metadata.
+
+    All leaves sit at the same depth, so line lookup, insert, delete and
+    split/join cost O(log n) plus the size of one chunk.
+    """
+
+    def __init__(self, lines: Iterable[str] = ()):
+        if not isinstance(lines, MappedLines):
+            lines = list(lines)
+        level = _build(lines, LEAF_MAX, _Leaf)
+        while len(level) > 1:
+            level = _build(level, KIDS_MAX, _Node)
+        self.root = level[0]
+
+    def __len__(self) -> int:
+        return self.root.size
+
+    def __iter__(self) -> Iterator[str]:
+        return self.lines()
+
+    def _index(self, y: int) -> int:
+        if y < 0:
+            y += self.root.size
+        if not 0 <= y < self.root.size:
+            raise IndexError("line index out of range")
+        return y
+
+    def _find(self, y: int):
+        """Return (path, leaf, y) where y is relative to the leaf."""
+        path = []
+        node = self.root
+        while type(node) is _Node:
+            last = len(node.kids) - 1
+            for i, kid in enumerate(node.kids):
+                if y < kid.size or i == last:
+                    break
+                y -= kid.size
+            path.append(node)
+            node = kid
+        return path, node, y
+
+    def _repair(self, path: list, leaf: _Leaf):
+        delta = len(leaf.items) - leaf.size
+        leaf.size += delta
+        if LEAF_MAX // 4 <= leaf.size <= LEAF_MAX or not path:
+            for node in path:
+                node.size += delta
+        else:
+            for node in reversed(path):
+                _normalize(node)
+        self._fix_root()
+
+    def _fix_root(self):
+        root = self.root
+        if type(root) is _Leaf:
+            pieces = _split(root)
+            root = pieces[0] if len(pieces) == 1 else _Node(pieces)
+        while type(root) is _Node and len(root.kids) > KIDS_MAX:
+            root = _Node(_split(root))
+        while type(root) is _Node and len(root.kids) <= 1:
+            root = root.kids[0] if root.kids else _Leaf([])
+        self.root = root
+
+    def __getitem__(self, y: int) -> str:
+        _, leaf, y = self._find(self._index(y))
+        return leaf.items[y]
+
+    def __setitem__(self, y: int, line: str):
+        _, leaf, y = self._find(self._index(y))
+        leaf.own()[y] = line
+
+    def insert(self, y: int, line: str):
+        self.splice(y, y, (line,))
+
+    def pop(self, y: int = -1) -> str:
+        y = self._index(y)
+        line = self[y]
+        self.splice(y, y + 1)
+        return line
+
+    def splice(self, start: int, stop: int, lines: Iterable[str] = ()):
+        """Replace lines[start:stop] with `lines`. The leaves of a Rope are
+        shared, only the nodes above the leaves are rebuilt."""
+        if isinstance(lines, Rope):
+            self.root = _stack(
+                [
+                    *self._cut(self.root, 0, start),
+                    *lines._cut(lines.root, 0, len(lines)),
+                    *self._cut(self.root, stop, self.root.size),
+                ]
+            )
+            return
+        lines = list(lines)
+        path, leaf, y = self._find(start)
+        if stop - start <= leaf.size - y:
+            leaf.own()[y : y + stop - start] = lines
+            self._repair(path, leaf)
+            return
+        self._delete(self.root, start, stop)
+        self._fix_root()
+        if lines:
+            path, leaf, y = self._find(start)
+            leaf.own()[y:y] = lines
+            self._repair(path, leaf)
+
+    def _delete(self, node, start: int, stop: int):
+        if type(node) is _Leaf:
+            del node.own()[start:stop]
+            node.size = len(node.items)
+            return
+        kids = []
+        for kid in node.kids:
+            n = kid.size
+            if start <= 0 and n <= stop:
+                pass
+            elif start < n and 0 < stop:
+                self._delete(kid, max(start, 0), min(stop, n))
+                kids.append(kid)
+            else:
+                kids.append(kid)
+            start -= n
+            stop -= n
+        node.kids = kids
+        _normalize(node)
+
+    def memory(self) -> int:
+        """Estimate the bytes held by decoded lines and line offsets."""
+        size = 0
+        offsets = {}
+        for leaf in self._leaves(self.root):
+            if type(leaf.items) is MappedLines:
+                offsets[id(leaf.items.offsets)] = leaf.items.offsets
+            else:
+                size += cost(leaf.items)
+        return size + sum(len(o) * o.itemsize for o in offsets.values())
+
+    def mapped(self) -> Iterator[MappedLines]:
+        """Yield the unmodified lines that are still read from a file."""
+        for leaf in self._leaves(self.root):
+            if type(leaf.items) is MappedLines:
+                yield leaf.items
+
+    def extend(self, lines: Iterable[str]):
+        """Append lines, keeping mapped ones mapped. Only the nodes above the
+        leaves are rebuilt, which is cheap next to the lines themselves."""
+        if not isinstance(lines, MappedLines):
+            lines = list(lines)
+        if not lines:
+            return
+        level = list(self._leaves(self.root))
+        self.root = _stack(level + _build(lines, LEAF_MAX, _Leaf))
+
+    def snapshot(self) -> "Rope":
+        """Return a copy that is not affected by later edits of this rope.
+
+        Only the tree is copied, the leaves share their lines until either
+        side modifies them.
+        """
+        copy = Rope.__new__(Rope)
+        copy.root = self._copy(self.root)
+        return copy
+
+    def slice(self, start: int, stop: int) -> Union[list[str], "Rope"]:
+        """Return lines start to stop, for more than a leaf of them as a Rope
+        sharing the leaves of this one until either side modifies them."""
+        if stop - start <= LEAF_MAX:
+            return list(self.lines(start, stop))
+        copy = Rope.__new__(Rope)
+        copy.root = _stack(list(self._cut(self.root, start, stop)))
+        return copy
+
+    def _cut(self, node, start: int, stop: int) -> Iterator[_Leaf]:
+        """Yield leaves holding lines start to stop of `node`."""
+        if type(node) is _Leaf:
+            if start <= 0 and stop >= node.size:
+                yield _share(node)
+            elif start < stop:
+                yield _Leaf(node.items[max(start, 0) : stop])
+            return
+        for kid in node.kids:
+            if stop <= 0:
+                break
+            if start < kid.size:
+                yield from self._cut(kid, start, min(stop, kid.size))
+            start -= kid.size
+            stop -= kid.size
+
+    def _copy(self, node):
+        if type(node) is _Leaf:
+            return _share(node)
+        copy = _Node.__new__(_Node)
+        copy.kids = [self._copy(kid) for kid in node.kids]
+        copy.size = node.size
+        return copy
+
+    def encode(self) -> Iterator[bytes]:
+        """Yield the lines joined by newlines as UTF-8, a leaf at a time.
+
+        Unmodified lines of a mapped file are copied without decoding them.
+        """
+        for i, leaf in enumerate(self._leaves(self.root)):
+            if i:
+                yield b"\n"
+            if type(leaf.items) is MappedLines:
+                yield leaf.items.encode()
+            else:
+                yield "\n".join(leaf.items).encode("utf-8", "surrogateescape")
+
+    def _leaves(self, node) -> Iterator[_Leaf]:
+        if type(node) is _Leaf:
+            yield node
+        else:
+            for kid in node.kids:
+                yield from self._leaves(kid)
+
+    def lines(self, start: int = 0, stop: int = None) -> Iterator[str]:
+        if stop is None or stop > self.root.size:
+            stop = self.root.size
+        return self._iter(self.root, start, stop)
+
+    def _iter(self, node, start: int, stop: int) -> Iterator[str]:
+        if type(node) is _Leaf:
+            yield from node.items[max(start, 0) : stop]
+            return
+        for kid in node.kids:
+            if stop <= 0:
+                break
+            if start < kid.size:
+                yield from self._iter(kid, start, min(stop, kid.size))
+            start -= kid.size
+            stop -= kid.size
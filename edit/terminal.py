@@ -1,12 +1,18 @@
-import sys
-from termios import *
-from shutil import get_terminal_size
+import codecs
+from typing import Union
+import timing
+from backend import TTY, Backend
 
 
 def isascii(c: str) -> bool:
     return 32 <= ord(c) <= 126 or c in "\n\t"
 
 
+def ischar(key: str) -> bool:
+    """Whether a key is a character to insert rather than a key name."""
+    return len(key) == 1 and (key.isprintable() or key == "\n")
+
+
 # fmt: off
 reset  = "\033[0m"
 bold   = "\033[1m"
@@ -50,20 +56,55 @@ brbgcyan   = "\033[106m"
 brbgwhite  = "\033[107m"
 # fmt: on
 
-width, height = get_terminal_size()
+# Frames are written to and keys read from this backend, see use().
+backend: Backend = TTY()
+width, height = backend.size()
+
+
+def use(new: Backend):
+    """Switch to another backend, e.g. a VirtualScreen to run headless."""
+    global backend, width, height
+    backend = new
+    width, height = new.size()
 
 
-def f():
-    sys.stdout.flush()
+def resize() -> bool:
+    """Pick up the new size after the terminal was resized, however many
+    times. Returns whether the size changed."""
+    global width, height
+    if not backend.resized() or backend.size() == (width, height):
+        return False
+    width, height = backend.size()
+    return True
 
 
-def w(s: str):
-    sys.stdout.write(s)
+# Everything written with w() is gathered here and sent by f() as one
+# write, so a frame costs a single syscall however many pieces it has.
+frame: list[str] = []
+w = frame.append
+# Totals of bytes written and write calls made, for benchmarks.
+written = 0
+writes = 0
+
+
+def f(render: bool = True):
+    """Send the frame. Only rendered frames end a frame of the profiler."""
+    global written, writes
+    profiler = timing.profiler if render else None
+    if profiler:
+        profiler.mark("render")
+    data = "".join(frame).encode(errors="replace")
+    frame.clear()
+    written += len(data)
+    writes += backend.write(data)
+    if profiler:
+        profiler.mark("flush")
+        profiler.frame(written, writes)
 
 
 def wf(s: str):
     w(s)
-    f()
+    f(render=False)
 
 
 def m(x: int, y: int):
@@ -81,143 +122,189 @@ def c():
 def chf():
     c()
     h()
-    f()
+    f(render=False)
 
 
 def setmode():
-    """
-    I don't know what the fuck this does but it does something to the terminal
-    device as to not fuck me over.
+    backend.setmode()
+    # Bracketed paste: the terminal wraps pasted text in PASTE_START/PASTE_END
+    # so it can be told apart from typing.
+    wf("\u001b[?2004h")
+
+
+def resetmode():
+    """Undo setmode()."""
+    wf("\u001b[?2004l")
+    backend.resetmode()
+
+
+# Escape sequences and control characters, mapped to key names. Printable
+# characters are passed through as themselves.
+KEYS = {
+    "\t": "TAB",
+    "\x7f": "BACKSPACE",
+    "\x1b\t": "ALT_TAB",
+    "\x1b[Z": "SHIFT_TAB",
+    "\x1b[200~": "PASTE_START",
+}
+PASTE_END = "\x1b[201~"
+for _c in range(1, 27):
+    if chr(_c) not in "\t\n":
+        KEYS[chr(_c)] = f"CTRL_{chr(64 + _c)}"
+_FINALS = {
+    "A": "UP_ARROW",
+    "B": "DOWN_ARROW",
+    "C": "RIGHT_ARROW",
+    "D": "LEFT_ARROW",
+    "H": "HOME",
+    "F": "END",
+}
+_TILDES = {
+    "1": "HOME",
+    "2": "INSERT",
+    "3": "DELETE",
+    "4": "END",
+    "5": "PG_UP",
+    "6": "PG_DOWN",
+    "7": "HOME",
+    "8": "END",
+}
+for _final, _name in _FINALS.items():
+    KEYS[f"\x1b[{_final}"] = _name
+    KEYS[f"\x1bO{_final}"] = _name
+for _num, _name in _TILDES.items():
+    KEYS[f"\x1b[{_num}~"] = _name
+_MODIFIERS = {
+    "2": "SHIFT_",
+    "3": "ALT_",
+    "4": "ALT_SHIFT_",
+    "5": "CTRL_",
+    "6": "CTRL_SHIFT_",
+}
+for _mod, _prefix in _MODIFIERS.items():
+    for _final, _name in _FINALS.items():
+        KEYS[f"\x1b[1;{_mod}{_final}"] = _prefix + _name
+    for _num, _name in _TILDES.items():
+        KEYS[f"\x1b[{_num};{_mod}~"] = _prefix + _name
+
+# Trie of the escape sequences, the key name of a node is stored under "".
+TRIE: dict = {}
+for _seq, _name in KEYS.items():
+    if _seq[0] == "\x1b":
+        _node = TRIE
+        for _c in _seq[1:]:
+            _node = _node.setdefault(_c, {})
+        _node[""] = _name
+
+
+class Paste(str):
+    """Text pasted by the user, delivered as a single key."""
+
+
+# How long to wait for the rest of an escape sequence before deciding that
+# the user pressed ESC (or ALT + key) on its own.
+ESC_TIMEOUT = 0.025
+
+
+class Decoder:
+    """Turn raw terminal input into key names, keeping incomplete sequences."""
+
+    def __init__(self):
+        self.pending = ""
+        self.utf8 = codecs.getincrementaldecoder("utf-8")("replace")
+        # Pieces of the paste being received, None outside of a paste.
+        self.paste: Union[list[str], None] = None
+
+    def feed(self, data: bytes, final: bool = False) -> list[str]:
+        """Decode `data` and return the complete keys in it.
+
+        With `final`, an incomplete escape sequence is not kept for the next
+        call but decoded as ESC or ALT + key.
+        """
+        s = self.pending + self.utf8.decode(data)
+        keys = []
+        i = 0
+        while i < len(s):
+            if self.paste is not None:
+                end = s.find(PASTE_END, i)
+                if end < 0:
+                    # Keep what could be the start of PASTE_END for next time.
+                    cut = max(i, len(s) - len(PASTE_END) + 1)
+                    self.paste.append(s[i:cut])
+                    i = cut
+                    break
+                self.paste.append(s[i:end])
+                text = "".join(self.paste).replace("\r\n", "\n").replace("\r", "\n")
+                keys.append(Paste(text))
+                self.paste = None
+                i = end + len(PASTE_END)
+                continue
+            key, n = self.match(s, i, final)
+            if not n:
+                break
+            if key == "PASTE_START":
+                self.paste = []
+            elif key:
+                keys.append(key)
+            i += n
+        self.pending = s[i:]
+        return keys
+
+    def match(self, s: str, i: int, final: bool) -> tuple[str, int]:
+        """Return the key at s[i] and its length, or a length of 0 if more
+        input is needed. Unknown escape sequences are returned as ""."""
+        if s[i] != "\x1b":
+            return KEYS.get(s[i], s[i]), 1
+        node = TRIE
+        found = None
+        j = i + 1
+        while j < len(s) and s[j] in node:
+            node = node[s[j]]
+            j += 1
+            if "" in node:
+                found = node[""], j - i
+        if j == len(s) and len(node) > ("" in node) and not final:
+            return "", 0
+        if found:
+            return found
+        if s.startswith("\x1b[", i):
+            # Skip unknown CSI sequences: parameters, intermediates, final.
+            j = i + 2
+            while j < len(s) and "\x20" <= s[j] <= "\x3f":
+                j += 1
+            if j < len(s):
+                return "", j + 1 - i
+            return "", 0 if not final else j - i
+        if i + 1 < len(s):
+            if isascii(s[i + 1]):
+                return f"ALT_{s[i + 1]}", 2
+            return "ESC", 1
+        return "ESC", 1 if final else 0
+
+
+decoder = Decoder()
+
+
+def read(timeout: float = None) -> list[str]:
+    """Wait up to `timeout` seconds for input and return every key in it.
 
-    References:
-      https://www.man7.org/linux/man-pages/man3/termios.3.html
-      https://man7.org/linux/man-pages/man1/stty.1.html
-      https://github.com/python/cpython/blob/3.10/Lib/tty.py
+    Whatever is available is read at once, so a burst of typing or key
+    repeat comes back as a single batch.
     """
-    IFLAG = 0
-    LFLAG = 3
-    CC = 6
-    mode = tcgetattr(sys.stdin)
-    mode[LFLAG] = mode[LFLAG] & ~(ECHO | ICANON)
-    mode[IFLAG] = mode[IFLAG] & ~(IXON | IXOFF)
-    #                             ^^^^ Allow Ctrl+S and Ctrl+Q to be read
-    mode[CC][VMIN] = 1
-    mode[CC][VTIME] = 0
-    tcsetattr(sys.stdin, TCSAFLUSH, mode)
-
-
-def read() -> str:
-    key = sys.stdin.read(1)
-    if isascii(key) and key != "\t":
-        return key
-    elif key == "\t":
-        return "TAB"
-    elif key == "\x7f":
-        return "BACKSPACE"
-    elif key == "\x01":
-        return "CTRL_A"
-    elif key == "\x02":
-        return "CTRL_B"
-    elif key == "\x04":
-        return "CTRL_D"
-    elif key == "\x05":
-        return "CTRL_E"
-    elif key == "\x06":
-        return "CTRL_F"
-    elif key == "\x07":
-        return "CTRL_G"
-    elif key == "\x08":
-        return "CTRL_H"
-    elif key == "\x0b":
-        return "CTRL_K"
-    elif key == "\x0c":
-        return "CTRL_L"
-    elif key == "\x0e":
-        return "CTRL_N"
-    elif key == "\x0f":
-        return "CTRL_O"
-    elif key == "\x10":
-        return "CTRL_P"
-    elif key == "\x11":
-        return "CTRL_Q"
-    elif key == "\x12":
-        return "CTRL_R"
-    elif key == "\x13":
-        return "CTRL_S"
-    elif key == "\x14":
-        return "CTRL_T"
-    elif key == "\x15":
-        return "CTRL_U"
-    elif key == "\x16":
-        return "CTRL_V"
-    elif key == "\x17":
-        return "CTRL_W"
-    elif key == "\x18":
-        return "CTRL_X"
-    elif key == "\x19":
-        return "CTRL_Y"
-    elif key == "\x1b":
-        key = sys.stdin.read(1)
-        if key == "\t":
-            return "ALT_TAB"
-        elif key == "[":
-            key = sys.stdin.read(1)
-            if key == "1":
-                key = sys.stdin.read(1)
-                if key == ";":
-                    key = sys.stdin.read(1)
-                    if key == "2":
-                        key = sys.stdin.read(1)
-                        if key == "A":
-                            return "SHIFT_UP_ARROW"
-                        elif key == "B":
-                            return "SHIFT_DOWN_ARROW"
-                        elif key == "C":
-                            return "SHIFT_RIGHT_ARROW"
-                        elif key == "D":
-                            return "SHIFT_LEFT_ARROW"
-                    if key == "3":
-                        key = sys.stdin.read(1)
-                        if key == "A":
-                            return "ALT_UP_ARROW"
-                        elif key == "B":
-                            return "ALT_DOWN_ARROW"
-                        elif key == "C":
-                            return "ALT_RIGHT_ARROW"
-                        elif key == "D":
-                            return "ALT_LEFT_ARROW"
-                    if key == "5":
-                        key = sys.stdin.read(1)
-                        if key == "A":
-                            return "CTRL_UP_ARROW"
-                        elif key == "B":
-                            return "CTRL_DOWN_ARROW"
-                        elif key == "C":
-                            return "CTRL_RIGHT_ARROW"
-                        elif key == "D":
-                            return "CTRL_LEFT_ARROW"
-            elif key == "5":
-                key = sys.stdin.read(1)
-                if key == "~":
-                    return "PG_UP"
-            elif key == "6":
-                key = sys.stdin.read(1)
-                if key == "~":
-                    return "PG_DOWN"
-            elif key == "A":
-                return "UP_ARROW"
-            elif key == "B":
-                return "DOWN_ARROW"
-            elif key == "C":
-                return "RIGHT_ARROW"
-            elif key == "D":
-                return "LEFT_ARROW"
-            elif key == "H":
-                return "HOME"
-            elif key == "F":
-                return "END"
-            elif key == "Z":
-                return "SHIFT_TAB"
-        elif isascii(key):
-            return f"ALT_{key}"
-    return key
+    while True:
+        data = backend.read(timeout)
+        if timing.profiler:
+            timing.profiler.mark("idle")
+        if data is None:
+            return []
+        if not data:
+            raise EOFError
+        keys = decoder.feed(data)
+        while decoder.pending and (data := backend.read(ESC_TIMEOUT)):
+            keys += decoder.feed(data)
+        if decoder.pending:
+            keys += decoder.feed(b"", final=True)
+        if timing.profiler:
+            timing.profiler.mark("read")
+        if keys or timeout is not None:
+            return keys
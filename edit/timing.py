@@ -0,0 +1,102 @@
+import time
+from array import array
+from typing import Union
+
+# The phases of a frame, in the order they happen. Idle is the time spent
+# waiting for input, read the time spent decoding it.
+PHASES = ("idle", "read", "dispatch", "poll", "render", "flush")
+
+
+def percentiles(values) -> dict[str, float]:
+    values = sorted(values)
+    if not values:
+        return {}
+
+    def at(p: float) -> float:
+        return values[min(len(values) - 1, int(p * len(values)))]
+
+    return {
+        "p50": at(0.5),
+        "p90": at(0.9),
+        "p99": at(0.99),
+        "max": values[-1],
+        "mean": sum(values) / len(values),
+    }
+
+
+class Profiler:
+    """Times the phases of every frame.
+
+    mark(phase) adds the time since the previous mark to `phase`, and the
+    flush at the end of a frame closes it. Frames are written to `path` as
+    JSON lines as they happen and summarized at the end.
+    """
+
+    def __init__(self, path: str):
+        import json
+
+        self.path = path
+        self.file = open(path, "w")
+        self.dumps = json.dumps
+        self.phases = dict.fromkeys(PHASES, 0.0)
+        self.keys = 0
+        # Totals of term.written and term.writes at the end of the last frame.
+        self.written = self.writes = 0
+        self.last = time.perf_counter()
+        self.frames = 0
+        self.history = {name: array("d") for name in (*PHASES, "bytes", "writes")}
+        self.shown = ""
+
+    def mark(self, phase: str, keys: int = 0):
+        now = time.perf_counter()
+        self.phases[phase] += now - self.last
+        self.last = now
+        self.keys += keys
+
+    def frame(self, written: int, writes: int):
+        """End a frame, given the totals of bytes and writes sent so far."""
+        record = {"frame": self.frames, "keys": self.keys}
+        for name, seconds in self.phases.items():
+            record[name + "_ms"] = round(seconds * 1000, 4)
+            self.history[name].append(seconds * 1000)
+            self.phases[name] = 0.0
+        record["bytes"] = written - self.written
+        record["writes"] = writes - self.writes
+        self.history["bytes"].append(record["bytes"])
+        self.history["writes"].append(record["writes"])
+        self.written, self.writes = written, writes
+        self.keys = 0
+        self.frames += 1
+        self.shown = (
+            f" read {record['read_ms']:.2f} keys {record['dispatch_ms']:.2f}"
+            f" poll {record['poll_ms']:.2f} draw {record['render_ms']:.2f}"
+            f" flush {record['flush_ms']:.2f} ms {record['bytes']} B "
+        )
+        self.file.write(self.dumps(record) + "\n")
+        # Writing the record is not part of the next frame.
+        self.last = time.perf_counter()
+
+    def status(self) -> str:
+        """Return the timings of the last frame for the status line."""
+        return self.shown
+
+    def close(self):
+        """Write a summary of every frame and close the trace."""
+        summary = {name: percentiles(values) for name, values in self.history.items()}
+        self.file.write(self.dumps({"frames": self.frames, "summary": summary}) + "\n")
+        self.file.close()
+
+
+profiler: Union[Profiler, None] = None
+
+
+def start(path: str):
+    global profiler
+    profiler = Profiler(path)
+
+
+def stop():
+    global profiler
+    if profiler:
+        profiler.close()
+        profiler = None
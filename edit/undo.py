@@ -0,0 +1,94 @@
+from collections import deque
+from typing import Union
+from storage import Rope, cost
+
+
+def held(lines: Union[list[str], Rope]) -> int:
+    """Estimate the memory held by recorded lines. Many old lines are a Rope,
+    see Rope.slice(), whose mapped lines are not decoded."""
+    return lines.memory() if isinstance(lines, Rope) else cost(lines)
+
+
+class Group:
+    """The edits made by one key: (start, old lines, new lines) splices."""
+
+    __slots__ = ("ops", "before", "after", "size")
+
+    def __init__(self, before: tuple[int, int]):
+        self.ops: list[tuple[int, Union[list[str], Rope], list[str]]] = []
+        self.before = before
+        self.after = before
+        self.size = 0
+
+
+class Undo:
+    """Bounded undo/redo journal of line splices.
+
+    Each group records the lines an edit replaced and the lines it put in
+    their place, so undoing or redoing costs the size of the edit. Typing or
+    deleting along a single line is merged into one group. When the journal
+    holds more than `budget` bytes the oldest groups are dropped, but never
+    the last one.
+    """
+
+    def __init__(self, budget: int = 64 << 20):
+        self.budget = budget
+        self.done: deque[Group] = deque()
+        self.undone: list[Group] = []
+        self.size = 0
+        self.group: Union[Group, None] = None
+
+    def begin(self, cursor: tuple[int, int]):
+        """Start recording the edits made by one key."""
+        self.group = Group(cursor)
+
+    def record(self, start: int, old: Union[list[str], Rope], new: list[str]):
+        if self.group is not None:
+            self.group.ops.append((start, old, new))
+            self.group.size += held(old) + cost(new)
+
+    def end(self, cursor: tuple[int, int]):
+        """Stop recording, merging the key's edits into the previous group
+        when both only changed the same line in place."""
+        group, self.group = self.group, None
+        if group is None or not group.ops:
+            return
+        group.after = cursor
+        for undone in self.undone:
+            self.size -= undone.size
+        self.undone.clear()
+        last = self.done[-1] if self.done else None
+        if last and self.mergeable(last, group):
+            start, old, new = last.ops[0]
+            self.size -= last.size
+            last.ops[0] = (start, old, group.ops[0][2])
+            last.size = cost(old) + cost(group.ops[0][2])
+            last.after = group.after
+            self.size += last.size
+        else:
+            self.done.append(group)
+            self.size += group.size
+        while self.size > self.budget and len(self.done) > 1:
+            self.size -= self.done.popleft().size
+
+    @staticmethod
+    def mergeable(last: Group, group: Group) -> bool:
+        if len(last.ops) != 1 or len(group.ops) != 1 or last.after != group.before:
+            return False
+        (a, old_a, new_a), (b, old_b, new_b) = last.ops[0], group.ops[0]
+        return a == b and len(old_a) == len(new_a) == len(old_b) == len(new_b) == 1
+
+    def undo(self) -> Union[Group, None]:
+        """Return the group to revert, its ops must be undone in reverse."""
+        if not self.done:
+            return None
+        group = self.done.pop()
+        self.undone.append(group)
+        return group
+
+    def redo(self) -> Union[Group, None]:
+        if not self.undone:
+            return None
+        group = self.undone.pop()
+        self.done.append(group)
+        return group
@@ -0,0 +1,186 @@
+import ctypes
+import difflib
+import os
+import struct
+import zlib
+from typing import Iterable
+from journal import base
+from storage import BLOCK, Blocks, split_lines
+
+# inotify events that mean a file in a watched directory may have new
+# contents: written in place, renamed over, created or removed.
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+# wd, mask, cookie and name length, followed by the name.
+EVENT = struct.Struct("iIII")
+
+# Changed regions of more than this many old lines times new lines are
+# diffed a chunk of lines at a time, and chunks replaced as a whole.
+DIFF_LIMIT = 1 << 22
+# Lines are cut into chunks after lines whose hash is a multiple of this, so
+# the same lines make the same chunks wherever they are.
+CHUNK = 64
+
+
+class Watcher:
+    """Notices when files change on disk.
+
+    On Linux the directories of the files are watched with inotify, so files
+    replaced by a rename are noticed too, and changed() only reads the events
+    that arrived. Elsewhere changed() compares sizes and mtimes, at most
+    every `interval` seconds.
+    """
+
+    def __init__(self, filenames: Iterable[str] = (), interval: float = 1.0):
+        self.interval = interval
+        # Last known (size, mtime_ns) of every file, by name.
+        self.stats: dict[str, tuple[int, int]] = {}
+        # Names by (directory watch, name within the directory).
+        self.names: dict[tuple[int, bytes], str] = {}
+        self.dirs: dict[str, int] = {}
+        self.fd = -1
+        try:
+            self.libc = ctypes.CDLL(None, use_errno=True)
+            self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except (AttributeError, OSError):
+            pass
+        for filename in filenames:
+            self.watch(filename)
+
+    def watch(self, filename: str):
+        self.stats[filename] = base(filename)
+        if self.fd < 0:
+            return
+        directory, name = os.path.split(os.path.abspath(filename))
+        if directory not in self.dirs:
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), MASK)
+            if wd < 0:
+                return
+            self.dirs[directory] = wd
+        self.names[self.dirs[directory], os.fsencode(name)] = filename
+
+    def timeout(self) -> float:
+        """How long the caller may wait before it should call changed()."""
+        return self.interval / 2 if self.fd >= 0 else self.interval
+
+    def changed(self) -> set[str]:
+        """Return the watched files that changed since the last call."""
+        if self.fd < 0:
+            candidates = self.stats
+        else:
+            candidates = self.events()
+        changed = set()
+        for filename in candidates:
+            stat = base(filename)
+            if stat != self.stats[filename]:
+                self.stats[filename] = stat
+                changed.add(filename)
+        return changed
+
+    def events(self) -> set[str]:
+        """Return the watched files that inotify reported events for."""
+        names = set()
+        while True:
+            try:
+                data = os.read(self.fd, 1 << 16)
+            except BlockingIOError:
+                return names
+            pos = 0
+            while pos < len(data):
+                wd, mask, _, size = EVENT.unpack_from(data, pos)
+                pos += EVENT.size
+                name = data[pos : pos + size].rstrip(b"\0")
+                pos += size
+                if mask & IN_Q_OVERFLOW:
+                    names.update(self.stats)
+                elif (wd, name) in self.names:
+                    names.add(self.names[wd, name])
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+def diff(blocks: Blocks, buf, new) -> list[tuple[int, int, list[str]]]:
+    """Return the (start, stop, lines) splices, in order, that turn `buf`, the
+    lines of a file that had `blocks`, into the lines of `new`, its contents
+    now.
+
+    The blocks the file still starts and ends with are found by their
+    hashes, so only the lines in between are decoded, from `buf` and `new`.
+    Those are compared one by one, or if there are many, a chunk of lines at
+    a time first.
+    """
+    crcs, size = blocks.crcs, blocks.size
+    # The blocks it starts with, and the newlines in them.
+    i = lines = 0
+    while i < len(crcs):
+        end = min((i + 1) * BLOCK, size)
+        block = new[i * BLOCK : end]
+        if len(block) != end - i * BLOCK or zlib.crc32(block) != crcs[i]:
+            break
+        lines += block.count(b"\n")
+        i += 1
+    if i == len(crcs) and size == len(new):
+        return []
+    # The changes start on the line the first changed block is on.
+    cut = new.rfind(b"\n", 0, min(i * BLOCK, size)) + 1
+    start = lines
+    # The blocks it ends with, now `shift` bytes further on, not reaching
+    # back before the changes start.
+    shift = len(new) - size
+    j = len(crcs) - 1
+    tail = 0
+    while j >= 0 and j * BLOCK >= cut and j * BLOCK + shift >= cut:
+        end = min((j + 1) * BLOCK, size)
+        block = new[j * BLOCK + shift : end + shift]
+        if zlib.crc32(block) != crcs[j]:
+            break
+        tail += block.count(b"\n")
+        j -= 1
+    # And end before the first newline of those blocks, the lines after it
+    # are unchanged.
+    if tail:
+        stop = new.find(b"\n", (j + 1) * BLOCK + shift)
+    else:
+        stop = len(new)
+    old_lines = list(buf.lines(start, len(buf) - tail))
+    return _diff_lines(old_lines, split_lines(new[cut:stop]), start)
+
+
+def _chunks(lines: list[str]) -> list[int]:
+    """Return where the chunks of `lines` start, and the end of the last."""
+    cuts = [y + 1 for y, line in enumerate(lines) if hash(line) % CHUNK == 0]
+    if not cuts or cuts[-1] != len(lines):
+        cuts.append(len(lines))
+    return [0, *cuts]
+
+
+def _diff_lines(a: list[str], b: list[str], start: int) -> list:
+    if len(a) * len(b) <= DIFF_LIMIT:
+        matcher = difflib.SequenceMatcher(None, a, b, autojunk=False)
+        return [
+            (start + i1, start + i2, b[j1:j2])
+            for tag, i1, i2, j1, j2 in matcher.get_opcodes()
+            if tag != "equal"
+        ]
+    ca, cb = _chunks(a), _chunks(b)
+    chunks_a = [tuple(a[i:j]) for i, j in zip(ca, ca[1:])]
+    chunks_b = [tuple(b[i:j]) for i, j in zip(cb, cb[1:])]
+    matcher = difflib.SequenceMatcher(None, chunks_a, chunks_b, autojunk=False)
+    splices = []
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            continue
+        a1, a2, b1, b2 = ca[i1], ca[i2], cb[j1], cb[j2]
+        if (a2 - a1) * (b2 - b1) <= DIFF_LIMIT:
+            splices += _diff_lines(a[a1:a2], b[b1:b2], start + a1)
+        else:
+            splices.append((start + a1, start + a2, b[b1:b2]))
+    return splices
@@ -0,0 +1,239 @@
+import unicodedata
+from array import array
+from bisect import bisect_right
+from functools import lru_cache
+from typing import Union
+
+TABSTOP = 4
+# How many widths other than the current one Wrap keeps counts for.
+WIDTHS = 4
+
+
+def char_width(c: str) -> int:
+    """Return how many columns a character other than a tab takes."""
+    if unicodedata.combining(c) or unicodedata.category(c) in ("Mn", "Me", "Cf"):
+        return 0
+    return 2 if unicodedata.east_asian_width(c) in "WF" else 1
+
+
+def simple(line: str) -> bool:
+    """Whether every character of a line takes one column."""
+    return line.isascii() and line.isprintable()
+
+
+class Layout:
+    """Where the characters of a line go on screen.
+
+    Character i is drawn at column xs[i] of the row that starts at the last
+    of `starts` not after i. Lines of ASCII characters, nearly all of them,
+    need neither table and are computed on the fly.
+    """
+
+    __slots__ = ("n", "wrap", "starts", "xs", "widths")
+
+    def __init__(self, n: int, wrap: int, starts=None, xs=None, widths=None):
+        self.n = n
+        self.wrap = wrap
+        self.starts: Union[array, None] = starts
+        self.xs: Union[array, None] = xs
+        # Columns used by every row.
+        self.widths: Union[array, None] = widths
+
+    def rows(self) -> int:
+        if self.starts is not None:
+            return len(self.starts)
+        return self.n // self.wrap + 1 if self.wrap else 1
+
+    def row(self, i: int) -> int:
+        """Return the row character i is on."""
+        if self.starts is not None:
+            return bisect_right(self.starts, i) - 1
+        return i // self.wrap if self.wrap else 0
+
+    def x(self, i: int) -> int:
+        """Return the column character i is at."""
+        if self.xs is not None:
+            return self.xs[i]
+        return i % self.wrap if self.wrap else i
+
+    def span(self, row: int) -> tuple[int, int]:
+        """Return the characters on a row, as a range."""
+        if self.starts is not None:
+            last = row + 1 == len(self.starts)
+            return self.starts[row], self.n if last else self.starts[row + 1]
+        if not self.wrap:
+            return 0, self.n
+        return row * self.wrap, min(self.n, (row + 1) * self.wrap)
+
+    def width(self, row: int) -> int:
+        if self.widths is not None:
+            return self.widths[row]
+        a, b = self.span(row)
+        return b - a
+
+    def index(self, row: int, x: int) -> int:
+        """Return the position on a row that is at or left of column x."""
+        a, b = self.span(row)
+        if row + 1 < self.rows():
+            b -= 1  # b is on the next row
+        if self.xs is None:
+            return min(a + x, b)
+        return max(a, bisect_right(self.xs, x, a, b + 1) - 1)
+
+    def cut(self, width: int) -> int:
+        """Return how many characters of the first row fit in `width`."""
+        if self.xs is None:
+            return min(self.n, width)
+        return bisect_right(self.xs, width, 0, self.span(0)[1] + 1) - 1
+
+    def text(self, line: str, a: int, b: int) -> str:
+        """Return characters a to b as they are drawn, with tabs expanded and
+        control characters replaced."""
+        segment = line[a:b]
+        if self.xs is None or segment.isprintable():
+            return segment
+        out = []
+        for i in range(a, b):
+            c = line[i]
+            if c == "\t":
+                end = self.xs[i + 1]
+                if end <= self.xs[i]:  # the tab ends the row
+                    end = self.width(self.row(i))
+                out.append(" " * (end - self.xs[i]))
+            elif c < " " or c == "\x7f":
+                out.append("?")
+            else:
+                out.append(c)
+        return "".join(out)
+
+
+@lru_cache(maxsize=4096)
+def layout(line: str, wrap: int = 0) -> Layout:
+    """Lay a line out in rows of `wrap` columns, or in one row if it is 0.
+
+    Layouts are cached by the text of the line, so an edit invalidates the
+    layout of the line it changes and no other.
+    """
+    if simple(line):
+        return Layout(len(line), wrap)
+    starts = array("I", [0])
+    xs = array("I")
+    widths = array("I")
+    x = 0
+    for i, c in enumerate(line):
+        w = 0 if c == "\t" else char_width(c)
+        if wrap and x > 0 and (x + w > wrap or c == "\t" and x >= wrap):
+            starts.append(i)
+            widths.append(x)
+            x = 0
+        if c == "\t":
+            w = TABSTOP - x % TABSTOP
+            if wrap:
+                w = min(w, wrap - x)
+        xs.append(x)
+        x += w
+    if wrap and x >= wrap:
+        # A line always has room for the cursor after its last character.
+        starts.append(len(line))
+        widths.append(x)
+        x = 0
+    xs.append(x)
+    widths.append(x)
+    return Layout(len(line), wrap, starts, xs, widths)
+
+
+def fit(text: str, width: int) -> str:
+    """Cut `text` to `width` columns and pad it with spaces to fill them."""
+    lay = layout(text)
+    n = lay.cut(width)
+    return lay.text(text, 0, n) + " " * (width - lay.x(n))
+
+
+class Wrap:
+    """Caches how many screen rows each line of a buffer wraps to.
+
+    Counts are computed when a line is first looked at and kept until it is
+    edited, like the Highlighter's states. The counts for the last few widths
+    are kept too, so resizing back and forth reuses them. Positions on
+    screen are (line, row within the line) pairs, and moving between them
+    only looks at the lines in between, so jumping far into a file never
+    wraps the lines before it.
+    """
+
+    def __init__(self, buf, width: int = 0):
+        self.buf = buf
+        # Columns per row, 0 to not wrap at all.
+        self.width = width
+        # Rows of every line, 0 where not known yet.
+        self.counts = array("I")
+        # Counts for other widths, the most recently used last.
+        self.cached: dict[int, array] = {}
+
+    def resize(self, width: int):
+        if width != self.width:
+            self.cached[self.width] = self.counts
+            self.counts = self.cached.pop(width, None) or array("I")
+            self.width = width
+            while len(self.cached) > WIDTHS:
+                del self.cached[next(iter(self.cached))]
+
+    def splice(self, start: int, stop: int, n: int):
+        """Note that lines start to stop were replaced by n lines."""
+        for counts in (self.counts, *self.cached.values()):
+            if start < len(counts):
+                counts[start:stop] = array("I", bytes(4 * n))
+
+    def rows(self, y: int) -> int:
+        if not self.width:
+            return 1
+        if y < len(self.counts) and self.counts[y]:
+            return self.counts[y]
+        if y >= len(self.counts):
+            self.counts.extend(bytes(4 * (y + 1 - len(self.counts))))
+        n = self.counts[y] = self.layout(y).rows()
+        return n
+
+    def layout(self, y: int) -> Layout:
+        return layout(self.buf[y], self.width)
+
+    def row(self, y: int, x: int) -> int:
+        """Return the row within line y that character x is on."""
+        return self.layout(y).row(x) if self.width else 0
+
+    def forward(self, y: int, sub: int, n: int) -> tuple[int, int]:
+        """Return the position n rows below (y, sub), at most the last row."""
+        while n:
+            rows = self.rows(y)
+            if sub + n < rows:
+                return y, sub + n
+            if y + 1 >= len(self.buf):
+                return y, rows - 1
+            n -= rows - sub
+            y += 1
+            sub = 0
+        return y, sub
+
+    def back(self, y: int, sub: int, n: int) -> tuple[int, int]:
+        """Return the position n rows above (y, sub), at least (0, 0)."""
+        while n > sub:
+            if y == 0:
+                return 0, 0
+            n -= sub + 1
+            y -= 1
+            sub = self.rows(y) - 1
+        return y, sub - n
+
+    def distance(self, a: tuple, b: tuple, limit: int) -> Union[int, None]:
+        """Return how many rows position b is below position a, or None if
+        that is more than `limit` rows either way."""
+        if b < a:
+            d = self.distance(b, a, limit)
+            return None if d is None else -d
+        (y, sub), (y1, sub1) = a, b
+        d = -sub
+        while y < y1:
+            d += self.rows(y)
+            y += 1
+            if d > limit:
+                return None
+        return d + sub1